@@ -3,9 +3,20 @@
 This module initializer holds common functions.
 """
 import os
+import re
 import json
+import logging
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+from fuzzywuzzy.process import extractOne
+from keystoneclient import exceptions as keystoneExceptions
+from random import uniform
 from requests import post
+from requests.exceptions import ConnectionError, ConnectTimeout, SSLError, Timeout
+from requests.packages.urllib3.exceptions import MaxRetryError, ProtocolError, ReadTimeoutError
+from time import sleep, time
 from unidecode import unidecode
+from urlparse import urlparse
 
 
 def sanitize(name):
@@ -48,5 +59,233 @@ def fileToRedmine(key=None, subject=None, message=None, priority='normal'):
         }
     }
 
-    post('https://support.forgeservicelab.fi/issues.json', data=json.dumps(issue),
-         headers={'Content-type': 'application/json', 'X-Redmine-API-Key': key})
+    RETRY_POLICY.request(post, 'https://support.forgeservicelab.fi/issues.json', idempotent=False,
+                         data=json.dumps(issue),
+                         headers={'Content-type': 'application/json', 'X-Redmine-API-Key': key})
+
+
+class RetryPolicy(object):
+
+    """Retry HTTP calls with bounded, jittered exponential backoff.
+
+    Responses and errors are classified by HTTP status: transient statuses are retried, honouring any Retry-After
+    the server sends, everything else is handed back to the caller straight away.
+    Non idempotent calls are only retried on statuses that guarantee the server did not act on the request, or if the
+    connection to the server could not be established at all.
+
+    Attributes:
+        TRANSIENT_STATUSES (List): HTTP statuses worth retrying idempotent calls on.
+        UNPROCESSED_STATUSES (List): HTTP statuses worth retrying non idempotent calls on.
+    """
+
+    TRANSIENT_STATUSES = [408, 429, 500, 502, 503, 504]
+    UNPROCESSED_STATUSES = [429, 503]
+
+    def __init__(self, max_attempts=8, base_delay=0.5, max_delay=60, deadline=300):
+        """Initialize the retry budget.
+
+        Args:
+            max_attempts (int, optional): Maximum number of attempts per call.
+            base_delay (float, optional): Seconds to wait before the first retry, doubled on each attempt.
+            max_delay (float, optional): Upper bound in seconds of a single wait.
+            deadline (float, optional): Seconds after which a call is no longer retried.
+        """
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def _isRetryable(self, status, idempotent):
+        return status in (self.TRANSIENT_STATUSES if idempotent else self.UNPROCESSED_STATUSES)
+
+    def _isTransportError(self, err):
+        return isinstance(err, (ConnectionError, Timeout, keystoneExceptions.ConnectionError)) and \
+            not isinstance(err, keystoneExceptions.SSLError)
+
+    def _notSent(self, err):
+        cause = err.args[0] if err.args else None
+        return isinstance(err, ConnectTimeout) or \
+            (not isinstance(err, (SSLError, Timeout)) and isinstance(cause, MaxRetryError) and
+             not isinstance(cause.reason, (ProtocolError, ReadTimeoutError)))
+
+    def _retryAfter(self, value):
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            date = parsedate_tz(value)
+            return max(mktime_tz(date) - time(), 0) if date else None
+
+    def _wait(self, attempt, started, retry_after=None):
+        delay = retry_after if retry_after is not None else \
+            uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if attempt + 1 >= self.max_attempts or time() - started + delay > self.deadline:
+            return False
+        sleep(delay)
+        return True
+
+    def request(self, send, uri, idempotent=True, **kwargs):
+        """Issue an HTTP request, retrying it on transient failures.
+
+        Args:
+            send (function): The requests function to issue the request with, e.g. requests.get or Session.put.
+            uri (str): URI to issue the request against.
+            idempotent (bool, optional): Whether the request can safely be repeated after the server processed it.
+            **kwargs: keyword arguments for the send function.
+
+        Returns:
+            requests.Response: The first non retryable response, or the last one if the retry budget runs out.
+
+        Raises:
+            requests.exceptions.RequestException: If the server could not be reached within the retry budget.
+        """
+        started = time()
+        attempt = 0
+        while True:
+            try:
+                response = send(uri, **kwargs)
+            except (ConnectionError, Timeout), err:
+                self._logger.warning('%s %s: %s' % (send.__name__, uri, err))
+                if not (idempotent or self._notSent(err)) or not self._wait(attempt, started):
+                    raise
+            else:
+                if not self._isRetryable(response.status_code, idempotent) or \
+                        not self._wait(attempt, started, self._retryAfter(response.headers.get('Retry-After'))):
+                    return response
+                self._logger.warning('%s %s: HTTP %d' % (send.__name__, uri, response.status_code))
+            attempt += 1
+
+    def call(self, function, *args, **kwargs):
+        """Call a client library function, retrying it on transient failures.
+
+        Errors are classified by the HTTP status the OpenStack client libraries attach to their exceptions. Failures
+        to reach the server, as raised by requests or wrapped by the Keystone session, are retried as well.
+
+        Args:
+            function (function): The function to call, must be safe to repeat.
+            *args: positional arguments for the function.
+            **kwargs: keyword arguments for the function.
+
+        Returns:
+            The return value of the function.
+        """
+        started = time()
+        attempt = 0
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception, err:
+                status = next((getattr(err, a) for a in ['http_status', 'status_code', 'code']
+                               if isinstance(getattr(err, a, None), int)), None)
+                if not (self._isTransportError(err) or self._isRetryable(status, True)) or \
+                        not self._wait(attempt, started, self._retryAfter(getattr(err, 'retry_after', None))):
+                    raise
+                self._logger.warning('%s: %s' % (getattr(function, '__name__', function), err))
+            attempt += 1
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+class FuzzyMatchCache(object):
+
+    """Memoize fuzzy string matching against small vocabularies.
+
+    Insightly roles and statuses and LDAP flags come from a handful of distinct values, so each distinct query is
+    scored once per process and answered from a bounded LRU cache afterwards.
+
+    Attributes:
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that had to be scored by fuzzywuzzy.
+    """
+
+    def __init__(self, maxsize=1024):
+        """Initialize an empty cache.
+
+        Args:
+            maxsize (int, optional): Maximum number of distinct lookups to remember.
+        """
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def extractOne(self, query, choices, score_cutoff=0):
+        """Find the best match for a query among a list of choices.
+
+        Drop-in replacement for fuzzywuzzy.process.extractOne.
+
+        Args:
+            query (str): String to match.
+            choices (List): List of strings to match the query against.
+            score_cutoff (int, optional): Minimum score for a choice to be considered a match.
+
+        Returns:
+            tuple: The best matching choice and its score.
+            None: If no choice scored above score_cutoff.
+        """
+        key = (query, tuple(choices), score_cutoff)
+        try:
+            match = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            match = extractOne(query, choices, score_cutoff=score_cutoff)
+            self.misses += 1
+            if len(self._cache) >= self._maxsize:
+                self._cache.popitem(last=False)
+        self._cache[key] = match
+
+        return match
+
+
+MATCH_CACHE = FuzzyMatchCache()
+
+
+class LatencyRecorder(object):
+
+    """Collect per-endpoint latency histograms of HTTP requests.
+
+    Latencies are counted in buckets of powers of two milliseconds, numeric path segments are collapsed so that all
+    requests for single records of the same collection share an endpoint.
+
+    Attributes:
+        histograms (dict): Bucket counts keyed by endpoint, in the format 'METHOD /path'.
+    """
+
+    def __init__(self):
+        """Initialize empty histograms."""
+        self.histograms = {}
+
+    def record(self, endpoint, seconds):
+        """Count a request on the histogram of an endpoint.
+
+        Args:
+            endpoint (str): Name of the endpoint the request was issued against.
+            seconds (float): Time the request took.
+        """
+        bucket = 1
+        while bucket < seconds * 1000:
+            bucket *= 2
+        histogram = self.histograms.setdefault(endpoint, {})
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def responseHook(self, response, *args, **kwargs):
+        """Record the latency of a response, to be registered as a requests response hook.
+
+        Args:
+            response (requests.Response): The response to record.
+        """
+        self.record('%s %s' % (response.request.method, re.sub(r'/\d+', '/{id}', urlparse(response.url).path)),
+                    response.elapsed.total_seconds())
+
+    def summary(self):
+        """Render the histograms.
+
+        Returns:
+            str: One line per endpoint listing request counts per latency bucket.
+        """
+        return '\n'.join('%s: %s' % (endpoint, ', '.join('<=%dms: %d' % (bucket, histogram[bucket])
+                                                         for bucket in sorted(histogram)))
+                         for endpoint, histogram in sorted(self.histograms.items()))
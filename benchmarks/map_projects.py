@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Benchmark mapping of Insightly projects to LDAP payloads.
+
+Maps the same synthetic Insightly contacts, projects and tenants with the indexed link resolution of ldapsync and
+with the per project scan of the whole contact and tenant lists that ldapsync used to do, and reports the time taken
+by each. The time taken by the list scans grows with contacts x projects x links, keep the defaults modest.
+
+Usage:
+    map_projects.py [-c <contacts>] [-p <projects>] [-l <links>]
+    map_projects.py -h | --help
+
+Options:
+    -h --help                   Show this screen.
+    -c --contacts <contacts>    Number of synthetic contacts [default: 1000].
+    -p --projects <projects>    Number of synthetic projects, each with its own tenant [default: 100].
+    -l --links <links>          Number of contacts linked to each project and tenant [default: 5].
+"""
+import os
+import sys
+from random import Random
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import ldapsync
+from docopt import docopt
+from fuzzywuzzy.process import extractOne
+from ldap_updater import LDAPUpdater
+
+ROLES = ['Tech', 'Admin Contact', 'Member', 'Developer']
+
+
+def syntheticContacts(count):
+    return map(lambda i: {'CONTACT_ID': 100000 + i,
+                          'FIRST_NAME': u'First%d' % i,
+                          'LAST_NAME': u'L\xe4st%d' % i,
+                          'CONTACTINFOS': [{'TYPE': 'EMAIL', 'DETAIL': u'user%d@example.com' % i},
+                                           {'TYPE': 'PHONE', 'DETAIL': u'+358 40 %07d' % i}],
+                          'CUSTOMFIELDS': [{'CUSTOM_FIELD_ID': 'CONTACT_FIELD_1', 'FIELD_VALUE': False}],
+                          'LINKS': []}, range(count))
+
+
+def syntheticProjects(count, contacts, links, first_id, tenants=None, random=Random(0)):
+    return map(lambda i: {'PROJECT_ID': first_id + i,
+                          'PROJECT_NAME': u'Project %d' % (first_id + i),
+                          'LINKS': map(lambda c: {'CONTACT_ID': c['CONTACT_ID'], 'SECOND_PROJECT_ID': None,
+                                                  'ROLE': random.choice(ROLES)},
+                                       random.sample(contacts, links)) +
+                          ([{'CONTACT_ID': None, 'SECOND_PROJECT_ID': tenants[i]['PROJECT_ID'], 'ROLE': None}]
+                           if tenants else [])}, range(count))
+
+
+def legacyMapProjectsToLDAP(project_list, project_type, users, tenant_list=False):
+    return map(lambda p: {'o': str(p['PROJECT_ID']),
+                          'description': project_type,
+                          'cn': ldapsync.sanitize(p['PROJECT_NAME']),
+                          'owner': ldapsync.mapContactsToLDAP(
+                              filter(lambda owner: owner['CONTACT_ID'] in
+                                     map(lambda c: c['CONTACT_ID'],
+                                         filter(lambda o: o['CONTACT_ID'] is not None and
+                                                extractOne(str(o['ROLE']), ldapsync.TECH_ROLE, score_cutoff=80),
+                                                p['LINKS'])), users))[:1],
+                          'seeAlso': ldapsync.mapContactsToLDAP(
+                              filter(lambda admin: admin['CONTACT_ID'] in
+                                     map(lambda c: c['CONTACT_ID'],
+                                         filter(lambda a: a['CONTACT_ID'] is not None and
+                                                extractOne(str(a['ROLE']), ldapsync.ADMIN_ROLE, score_cutoff=80),
+                                                p['LINKS'])), users)),
+                          'member': ldapsync.mapContactsToLDAP(
+                              filter(lambda member: member['CONTACT_ID'] in
+                                     map(lambda c: c['CONTACT_ID'],
+                                         filter(lambda m: m['CONTACT_ID'] is not None, p['LINKS'])), users)),
+                          'tenants': legacyMapProjectsToLDAP(
+                              filter(lambda t: t['PROJECT_ID'] in
+                                     map(lambda sp: sp['SECOND_PROJECT_ID'],
+                                         filter(lambda l: l['SECOND_PROJECT_ID'] is not None, p['LINKS'])),
+                                     tenant_list),
+                              project_type + [LDAPUpdater.OS_TENANT], users) if tenant_list else [],
+                          }, project_list) if project_list else []
+
+
+def indexedMapProjectsToLDAP(project_list, project_type, users, tenant_list):
+    ldapsync.CONTACTS = ldapsync.indexRecords(iter(users), 'CONTACT_ID',
+                                              transform=lambda c: ldapsync.mapContactsToLDAP([c])[0])
+    return ldapsync.mapProjectsToLDAP(project_list, project_type,
+                                      tenant_index=ldapsync.indexRecords(tenant_list, 'PROJECT_ID'))
+
+
+def timeMapping(mapping, *args):
+    started = time()
+    result = mapping(*args)
+    return time() - started, result
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    ldapsync.LU = LDAPUpdater
+    contacts = syntheticContacts(int(arguments['--contacts']))
+    tenants = syntheticProjects(int(arguments['--projects']), contacts, int(arguments['--links']), 500000)
+    projects = syntheticProjects(int(arguments['--projects']), contacts, int(arguments['--links']), 1, tenants)
+
+    legacy, legacy_result = timeMapping(legacyMapProjectsToLDAP, projects, [LDAPUpdater.SDA], contacts, tenants)
+    indexed, indexed_result = timeMapping(indexedMapProjectsToLDAP, projects, [LDAPUpdater.SDA], contacts, tenants)
+
+    print 'Mapped %d projects with %d tenants, %d links each, against %d contacts' % (len(projects), len(tenants),
+                                                                                    int(arguments['--links']),
+                                                                                    len(contacts))
+    print '  List scans:    %8.3fs' % legacy
+    print '  Indexed links: %8.3fs' % indexed
+    print '  Speed-up:      %8.1fx' % (legacy / indexed)
+    print '  Results match: %s' % (legacy_result == indexed_result)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Benchmark rendering of canned mail messages.
+
+Renders the same notifications with the precompiled templates of CannedMailer and with a MIMEText built per message,
+as CannedMailer used to, and reports the time taken by each.
+
+Usage:
+    render_canned_mail.py [-n <notifications>]
+    render_canned_mail.py -h | --help
+
+Options:
+    -h --help                               Show this screen.
+    -n --notifications <notifications>      Number of notifications to render [default: 100000].
+"""
+import os
+import sys
+from time import time
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from docopt import docopt
+from canned_mailer import CannedMailer
+
+
+def renderWithMIMEText(mailer, to, cannedMessage, token):
+    message = MIMEText(mailer.CANNED_MESSAGES[cannedMessage]['body'].format(TOKEN=token).decode('utf-8'),
+                       'plain', 'UTF-8')
+    message['Subject'] = mailer.CANNED_MESSAGES[cannedMessage]['subject']
+    message['To'] = to
+    message['From'] = mailer._FROM
+    return message.as_string()
+
+
+def renderPrecompiled(mailer, to, cannedMessage, token):
+    return mailer._render(to, [(cannedMessage, token)])
+
+
+def timeRenders(render, mailer, notifications):
+    started = time()
+    map(lambda (to, cannedMessage, token): render(mailer, to, cannedMessage, token), notifications)
+    return time() - started
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    count = int(arguments['--notifications'])
+    mailer = CannedMailer({})
+    names = sorted(mailer.CANNED_MESSAGES.keys())
+    notifications = map(lambda i: ('user%d@example.com' % i, names[i % len(names)], 'token%d' % i), range(count))
+
+    baseline = timeRenders(renderWithMIMEText, mailer, notifications)
+    precompiled = timeRenders(renderPrecompiled, mailer, notifications)
+
+    print 'Rendered %d notifications' % count
+    print '  MIMEText per message:  %8.3fs (%6.1f us/message)' % (baseline, baseline * 1e6 / count)
+    print '  Precompiled templates: %8.3fs (%6.1f us/message)' % (precompiled, precompiled * 1e6 / count)
+    print '  Speed-up:              %8.1fx' % (baseline / precompiled)
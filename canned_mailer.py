@@ -1,13 +1,47 @@
 """Canned Mailer."""
+import os
+import socket
+import logging
 import smtplib
-from email.mime.text import MIMEText
+from collections import OrderedDict
+from base64 import encodestring
+from Queue import Queue, Empty
+from threading import Thread
+from time import time
+from uuid import uuid4
 
 
 class CannedMailer:
 
-    """Send Canned Mails."""
+    """Send Canned Mails.
+
+    Messages requested during a run are collected per recipient, duplicates dropped, and each recipient gets a single
+    digest of all their notifications when the mailer is flushed.
+    Digests are delivered by a background thread over a single SMTP connection.
+    If a spool directory is configured, requested messages are written to it as they are requested, and digests before
+    being queued and only removed once delivered, so that mail left undelivered by an SMTP outage or a crash is
+    delivered on the next run.
+    Mail the server defers is kept spooled while delivery goes on with the rest of the queue, mail it rejects for good
+    is moved to the 'failed' subdirectory of the spool. Delivery stops for the run only if the server cannot be
+    reached.
+
+    Attributes:
+        DELIVERY_ATTEMPTS (int): Number of connections to attempt a message delivery on before giving it up.
+        SMTP_TIMEOUT (int): Seconds to wait for the SMTP server to respond.
+        IDLE_TIMEOUT (int): Seconds to keep an idle SMTP connection open.
+    """
+
+    DELIVERY_ATTEMPTS = 2
+    SMTP_TIMEOUT = 30
+    IDLE_TIMEOUT = 30
 
     _FROM = 'support@forgeservicelab.fi'
+    _FAILED = 'failed'
+
+    _DIGEST_SUBJECT = 'Your FORGE Service Lab notifications ({COUNT})'
+    _DIGEST_SEPARATOR = '\n\n%s\n\n' % ('-' * 72)
+    _HEADERS = 'MIME-Version: 1.0\nContent-Type: text/plain; charset="utf-8"\nContent-Transfer-Encoding: base64\n' \
+        'Subject: %s\nTo: %s\nFrom: ' + _FROM + '\n\n'
 
     _NEW_ACCOUNT_PARTNER = {
         'subject': 'Welcome to FORGE Service Lab!',
@@ -157,35 +191,188 @@ support@forgeservicelab.fi"""
         'disabled_account': _ACCOUNT_DISABLED,
     }
 
+    _TEMPLATES = dict(map(lambda (name, cannedMessage): (name, cannedMessage['body'].strip().split('{TOKEN}')),
+                          CANNED_MESSAGES.items()))
+
     def __init__(self, args):
         """Initialize Canned mailer.
 
+        Queue any mail left on the spool directory by previous runs, and add any requested message left undigested to
+        the digests of this run.
+
         Args:
             args (dict): Configuration arguments as generated by DocOpt.
         """
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._pending = Queue()
+        self._worker = None
+        self._outage = False
+        self._sequence = 0
+        self._digests = OrderedDict()
         self.useMandrill = all(key in args.keys() for key in ['--mandrill-username', '--mandrill-password'])
         if self.useMandrill:
             self.mandrillUser = args['--mandrill-username']
             self.mandrillPass = args['--mandrill-password']
 
+        self._spool = args.get('--mail_spool')
+        if self._spool:
+            if not os.path.isdir(self._spool):
+                os.makedirs(self._spool)
+            map(lambda path: self._enqueue(path, *self._readSpooled(path)),
+                map(lambda f: os.path.join(self._spool, f),
+                    sorted(filter(lambda f: f.endswith('.msg'), os.listdir(self._spool)))))
+            map(lambda path: self._addToDigest(path, *self._readSpooled(path, 3)),
+                map(lambda f: os.path.join(self._spool, f),
+                    sorted(filter(lambda f: f.endswith('.evt'), os.listdir(self._spool)))))
+
+    def _readSpooled(self, path, fields=2):
+        with open(path, 'r') as f:
+            return f.read().split('\n', fields - 1)
+
+    def _writeSpooled(self, extension, *fields):
+        self._sequence += 1
+        path = os.path.join(self._spool, '%d-%08d-%s.%s' % (time() * 1000, self._sequence, uuid4().hex, extension))
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(fields))
+        os.rename(path + '.tmp', path)
+        return path
+
+    def _enqueue(self, path, to, message):
+        if not self._worker:
+            self._worker = Thread(target=self._deliverAll, name='CannedMailerWorker')
+            self._worker.daemon = True
+            self._worker.start()
+        self._pending.put((path, to, message))
+
+    def _connect(self):
+        if self.useMandrill:
+            s = smtplib.SMTP('smtp.mandrillapp.com', 587, timeout=self.SMTP_TIMEOUT)
+            s.login(self.mandrillUser, self.mandrillPass)
+        else:
+            s = smtplib.SMTP('localhost', timeout=self.SMTP_TIMEOUT)
+        return s
+
+    def _disconnect(self, connection):
+        if connection:
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+
+    def _reject(self, path):
+        if path:
+            failed = os.path.join(self._spool, self._FAILED)
+            if not os.path.isdir(failed):
+                os.makedirs(failed)
+            os.rename(path, os.path.join(failed, os.path.basename(path)))
+
+    def _deliver(self, connection, path, to, message):
+        if self._outage:
+            return connection
+
+        kept = 'keeping undelivered mail spooled.' if self._spool else 'dropping undelivered mail.'
+        for attempt in range(self.DELIVERY_ATTEMPTS):
+            try:
+                connection = connection or self._connect()
+            except (smtplib.SMTPException, socket.error), err:
+                connection = None
+                continue
+
+            try:
+                connection.sendmail(self._FROM, to, message)
+            except (smtplib.SMTPServerDisconnected, socket.error), err:
+                connection = None
+                continue
+            except smtplib.SMTPRecipientsRefused, err:
+                permanent = all(code >= 500 for code, response in err.recipients.values())
+            except smtplib.SMTPResponseException, err:
+                permanent = err.smtp_code >= 500
+            except smtplib.SMTPException, err:
+                permanent = False
+            else:
+                if path:
+                    os.remove(path)
+                return connection
+
+            if permanent:
+                self._logger.error('Mail to %s was rejected: %s; %s' % (
+                    to, err, 'moving it to the %s spool directory.' % self._FAILED if self._spool else 'dropping it.'))
+                self._reject(path)
+            else:
+                self._logger.warning('Mail to %s was deferred: %s; %s' % (to, err, kept))
+            return connection
+
+        self._outage = True
+        self._disconnect(connection)
+        self._logger.error('Could not deliver mail to %s: %s; %s' % (to, err, kept))
+        return None
+
+    def _deliverAll(self):
+        connection = None
+        while True:
+            try:
+                item = self._pending.get(timeout=self.IDLE_TIMEOUT)
+            except Empty:
+                self._disconnect(connection)
+                connection = None
+                continue
+
+            if not item:
+                self._disconnect(connection)
+                return
+
+            try:
+                connection = self._deliver(connection, *item)
+            except Exception, err:
+                self._logger.exception(err)
+
+    def _fill(self, cannedMessage, token):
+        return token.join(self._TEMPLATES[cannedMessage])
+
+    def _render(self, to, events):
+        body = self._DIGEST_SEPARATOR.join(map(lambda (name, token): self._fill(name, token), events))
+        subject = self.CANNED_MESSAGES[events[0][0]]['subject'] if len(events) == 1 else \
+            self._DIGEST_SUBJECT.format(COUNT=len(events))
+        return self._HEADERS % (subject, to) + encodestring(body)
+
+    def _addToDigest(self, path, to, cannedMessage, token):
+        events = self._digests.setdefault(to, OrderedDict())
+        if (cannedMessage, token) in events:
+            if path:
+                os.remove(path)
+        else:
+            events[(cannedMessage, token)] = path
+
     def sendCannedMail(self, to, cannedMessage, token):
-        """Send the specified canned mail message.
+        """Add the specified canned mail message to the recipient's digest.
+
+        The digest is delivered when the mailer is flushed, sending the same message and token to the same recipient
+        more than once during a run only includes it once. The message is spooled right away if there is a spool
+        directory, so that it is not lost if the run does not get to flush the mailer.
 
         Args:
             to (str): Email address to mail the message to.
             cannedMessage (str): Message to deliver, one of the keys on the CANNED_MESSAGES dictionary.
             token (str): String to replace the '{TOKEN}' placeholder on the canned message.
         """
-        message = MIMEText(cannedMessage['body'].format(TOKEN=token).decode('utf-8'), 'plain', 'UTF-8')
-        message['Subject'] = cannedMessage['subject']
-        message['To'] = to
-        message['From'] = self._FROM
+        token = token.encode('utf-8') if isinstance(token, unicode) else str(token)
+        if (cannedMessage, token) not in self._digests.get(to, {}):
+            self._addToDigest(self._writeSpooled('evt', to, cannedMessage, token) if self._spool else None,
+                              to, cannedMessage, token)
 
-        if self.useMandrill:
-            s = smtplib.SMTP('smtp.mandrillapp.com', 587)
-            s.login(self.mandrillUser, self.mandrillPass)
-        else:
-            s = smtplib.SMTP('localhost')
+    def flush(self):
+        """Deliver the digest for every recipient, then close the SMTP connection and stop the background thread.
 
-        s.sendmail(self._FROM, to, message.as_string())
-        s.quit()
+        Digests are spooled before delivery, replacing the spooled messages they are made of. Messages that cannot be
+        delivered are logged, and kept on the spool directory if there is one.
+        """
+        digests, self._digests = self._digests, OrderedDict()
+        for to, events in digests.iteritems():
+            message = self._render(to, events.keys())
+            self._enqueue(self._writeSpooled('msg', to, message) if self._spool else None, to, message)
+            map(os.remove, filter(None, events.values()))
+
+        if self._worker:
+            self._pending.put(None)
+            self._worker.join()
+            self._worker = None
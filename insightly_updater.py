@@ -1,6 +1,16 @@
 """Update Insightly data."""
 import json
-from requests import get, post, put
+from calendar import timegm
+from collections import OrderedDict, namedtuple
+from copy import deepcopy
+from email.utils import formatdate
+from time import strptime, time
+from __init__ import LatencyRecorder, RETRY_POLICY
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+
+StageGraph = namedtuple('StageGraph', ['by_order', 'next_stage'])
 
 
 class InsightlyUpdater:
@@ -8,6 +18,7 @@ class InsightlyUpdater:
     """Push updates to Insightly.
 
     Update Insightly projects based on project status changes due to LDAP synchronization operations.
+    Project updates are queued and merged per project until flush is called.
 
     Attributes:
         INSIGHTLY_PROJECTS_URI (str): URI of Insightly's REST API Projects endpoint.
@@ -19,6 +30,15 @@ class InsightlyUpdater:
         STATUS_RUNNING (str): Constant defining the Insightly name for a project's running status.
         STATUS_DEFERRED (str): Constant defining the Insightly name for a project's deferred status.
         STATUS_COMPLETED (str): Constant defining the Insightly name for a project's completed status.
+
+        PAGE_SIZE (int): Default number of records to request per page when fetching Insightly collections.
+        IDS_BATCH (int): Number of record IDs to request at once when fetching records by ID.
+        POOL_SIZE (int): Default number of keep-alive connections to hold open against Insightly.
+        PROJECT_CACHE_TTL (int): Seconds a cached project document is trusted before it is revalidated.
+
+        STAGE_GRAPH (StageGraph): Pipeline stages indexed by (PIPELINE_ID, STAGE_ORDER), and the STAGE_ID following
+            each STAGE_ID on its pipeline.
+        LATENCY (LatencyRecorder): Per-endpoint latency histograms of all requests made through Insightly sessions.
     """
 
     INSIGHTLY_PROJECTS_URI = 'https://api.insight.ly/v2.1/Projects/'
@@ -31,36 +51,158 @@ class InsightlyUpdater:
     STATUS_DEFERRED = 'Deferred'
     STATUS_COMPLETED = 'Completed'
 
-    def __init__(self, api_key=None, stages=[], tenant_category=None):
+    PAGE_SIZE = 500
+    IDS_BATCH = 100
+    POOL_SIZE = 4
+    PROJECT_CACHE_TTL = 600
+
+    LATENCY = LatencyRecorder()
+
+    def __init__(self, api_key=None, stages=[], tenant_category=None, session=None):
         """Initialize instance-dependent class constants.
 
         Args:
             api_key (str): Insightly API key.
-            stages (List): A list of all the pipeline stages on the Insightly instance.
+            stages (List): A list of all the pipeline stages on the Insightly instance, indexed on STAGE_GRAPH.
             tenant_category (str): The ID of the Insightly category that represents an OpenStack tenant project.
+            session (requests.Session, optional): Session to issue Insightly requests through,
+                as generated by createSession. A new one is created if not given.
         """
         self.INSIGHTLY_API_KEY = api_key
         self.STAGES = stages
+        self.STAGE_GRAPH = self._buildStageGraph(stages)
         self.TENANT_CATEGORY = tenant_category
+        self.session = session or self.createSession(api_key)
+        self._pending = OrderedDict()
+        self._projects = {}
+
+    def _buildStageGraph(self, stages):
+        by_order = dict(((s['PIPELINE_ID'], s['STAGE_ORDER']), s) for s in stages)
+        next_stage = dict((s['STAGE_ID'], by_order[(s['PIPELINE_ID'], s['STAGE_ORDER'] + 1)]['STAGE_ID'])
+                          for s in stages if (s['PIPELINE_ID'], s['STAGE_ORDER'] + 1) in by_order)
+
+        return StageGraph(by_order, next_stage)
+
+    @classmethod
+    def createSession(cls, api_key, pool_size=None):
+        """Create an HTTP session for the Insightly REST API.
+
+        The session authenticates every request, accepts compressed responses, keeps connections alive on a pool and
+        records request latencies on LATENCY.
+
+        Args:
+            api_key (str): Insightly API key.
+            pool_size (int, optional): Number of connections to keep on the pool, defaults to POOL_SIZE.
+
+        Returns:
+            requests.Session: The configured session.
+        """
+        session = Session()
+        session.auth = (api_key, '')
+        session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or cls.POOL_SIZE))
+        session.hooks['response'].append(cls.LATENCY.responseHook)
+        return session
+
+    def _getPage(self, uri, params):
+        response = RETRY_POLICY.request(self.session.get, uri, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def iterRecords(self, uri, page_size=None, updated_since=None, ids=None):
+        """Fetch an Insightly collection one page at a time.
+
+        Only one page of records is held in memory at any given time.
+
+        Args:
+            uri (str): URI of an Insightly REST API collection endpoint, e.g. INSIGHTLY_PROJECTS_URI.
+            page_size (int, optional): Number of records to request per page, defaults to PAGE_SIZE,
+                or to IDS_BATCH when fetching by ID.
+            updated_since (str, optional): UTC timestamp in the format YYYY-MM-DDTHH:MM:SS,
+                fetch only records updated after it.
+            ids (iterable, optional): Fetch only the records with these IDs.
+
+        Yields:
+            dict: Each record on the collection as JSON from Insightly.
+        """
+        if ids is not None:
+            page_size = page_size or self.IDS_BATCH
+            ids = sorted(ids)
+            for chunk in range(0, len(ids), page_size):
+                for record in self._getPage(uri, {'ids': ','.join(map(str, ids[chunk:chunk + page_size]))}):
+                    yield record
+        else:
+            page_size = page_size or self.PAGE_SIZE
+            params = {'$filter': "DATE_UPDATED_UTC gt DateTime'%s'" % updated_since} if updated_since else {}
+            skip = 0
+            while True:
+                page = self._getPage(uri, dict(params, skip=skip, top=page_size))
+                for record in page:
+                    yield record
+                if len(page) < page_size:
+                    break
+                skip += page_size
+
+    def cacheProject(self, insightly_project, etag=None):
+        """Store a project document on the project cache.
 
-    def _getInsightlyProject(self, project):
-        return get(self.INSIGHTLY_PROJECTS_URI + str(project['o']), auth=(self.INSIGHTLY_API_KEY, '')).json()
+        Cached documents are served by single project reads until PROJECT_CACHE_TTL expires,
+        then revalidated against Insightly using their ETag or DATE_UPDATED_UTC. Reads made to write a project back
+        are always revalidated.
+
+        Args:
+            insightly_project (dict): A project as JSON from Insightly.
+            etag (str, optional): The ETag Insightly sent along with the project.
+        """
+        self._projects[str(insightly_project['PROJECT_ID'])] = (time(), etag, deepcopy(insightly_project))
+
+    def _cacheResponse(self, response):
+        if response.status_code == 200:
+            self.cacheProject(response.json(), etag=response.headers.get('ETag'))
+        return response
+
+    def _getInsightlyProject(self, project, revalidate=False):
+        project_id = str(project['o'])
+        cached = self._projects.get(project_id)
+        if cached and not revalidate and time() - cached[0] < self.PROJECT_CACHE_TTL:
+            return deepcopy(cached[2])
+
+        headers = {}
+        if cached and cached[1]:
+            headers['If-None-Match'] = cached[1]
+        elif cached and cached[2].get('DATE_UPDATED_UTC'):
+            headers['If-Modified-Since'] = formatdate(timegm(strptime(cached[2]['DATE_UPDATED_UTC'],
+                                                                      '%Y-%m-%d %H:%M:%S')), usegmt=True)
+
+        response = RETRY_POLICY.request(self.session.get, self.INSIGHTLY_PROJECTS_URI + project_id, headers=headers)
+        if response.status_code == 304:
+            self._projects[project_id] = (time(),) + cached[1:]
+            return deepcopy(cached[2])
+        return self._cacheResponse(response).json()
+
+    def _putInsightlyProject(self, insightly_project):
+        self._cacheResponse(RETRY_POLICY.request(self.session.put, self.INSIGHTLY_PROJECTS_URI,
+                                                 data=json.dumps(insightly_project),
+                                                 headers={'Content-Type': 'application/json'}))
+
+    def _queue(self, project, mutation):
+        self._pending.setdefault(str(project['o']), []).append(mutation)
 
     def _getNextStage(self, insightly_project):
-        return filter(lambda s:
-                      s['STAGE_ORDER'] in map(lambda o: o['STAGE_ORDER'] + 1,
-                                              filter(lambda f: f['STAGE_ID'] == insightly_project['STAGE_ID'],
-                                                     filter(lambda s:
-                                                            s['PIPELINE_ID'] == insightly_project['PIPELINE_ID'],
-                                                            self.STAGES))) and
-                      s['PIPELINE_ID'] == insightly_project['PIPELINE_ID'], self.STAGES)[0]['STAGE_ID']
+        return self.STAGE_GRAPH.next_stage[insightly_project['STAGE_ID']]
+
+    def _advanceProject(self, insightly_project, updateStage, status):
+        if updateStage:
+            insightly_project['STAGE_ID'] = self._getNextStage(insightly_project)
+        if status:
+            insightly_project['STATUS'] = status
 
     def createDefaultTenantFor(self, project):
         """Create a default tenant for a project.
 
         Create a project of category 'OpenStack tenant' on Insightly if a project of type 'SDA' or 'FPA (CRA)'
         does not have at least one tenant.
-        Update the parent project on Insightly so that it contains a reference to its default tenant.
+        Queue an update of the parent project on Insightly so that it contains a reference to its default tenant.
 
         Args:
             project (dict): A project as a dictionary of relevant LDAP Attributes.
@@ -83,31 +225,26 @@ class InsightlyUpdater:
                 }]
             }
 
-            tenant = post(self.INSIGHTLY_PROJECTS_URI,
-                          data=json.dumps(payload),
-                          headers={'Content-Type': 'application/json'},
-                          auth=(self.INSIGHTLY_API_KEY, '')).json()
-
-            parent['LINKS'] = parent['LINKS'] + [{'SECOND_PROJECT_ID': tenant['PROJECT_ID']}]
+            tenant = self._cacheResponse(RETRY_POLICY.request(self.session.post, self.INSIGHTLY_PROJECTS_URI,
+                                                              idempotent=False,
+                                                              data=json.dumps(payload),
+                                                              headers={'Content-Type': 'application/json'})).json()
 
-            put(self.INSIGHTLY_PROJECTS_URI,
-                data=json.dumps(parent),
-                headers={'Content-Type': 'application/json'},
-                auth=(self.INSIGHTLY_API_KEY, ''))
+            self._queue(project, lambda p: p.update(LINKS=p['LINKS'] + [{'SECOND_PROJECT_ID': tenant['PROJECT_ID']}]))
 
         return tenant
 
     def addUserToProject(self, userid, project):
-        insightly_project = self._getInsightlyProject(project)
-        insightly_project['LINKS'] += [{'CONTACT_ID': userid}]
+        """Queue linking a contact to a project on Insightly.
 
-        put(self.INSIGHTLY_PROJECTS_URI,
-            data=json.dumps(insightly_project),
-            headers={'Content-Type': 'application/json'},
-            auth=(self.INSIGHTLY_API_KEY, ''))
+        Args:
+            userid (str): The Insightly ID of the contact to link.
+            project (dict): A project as a dictionary of relevant LDAP Attributes.
+        """
+        self._queue(project, lambda p: p.update(LINKS=p['LINKS'] + [{'CONTACT_ID': userid}]))
 
     def updateProject(self, project, updateStage=True, status=None):
-        """Update a project on Insightly to represent a change on its status or pipeline stage.
+        """Queue an update of a project on Insightly to represent a change on its status or pipeline stage.
 
         Args:
             project (dict): A project as a dictionary of relevant LDAP Attributes.
@@ -115,13 +252,17 @@ class InsightlyUpdater:
             status (str, optional): Modify the project status if present.
                 One of STATUS_RUNNING, STATUS_DEFERRED or STATUS_COMPLETED
         """
-        insightly_project = self._getInsightlyProject(project)
-        if updateStage:
-            insightly_project['STAGE_ID'] = self._getNextStage(insightly_project)
-        if status:
-            insightly_project['STATUS'] = status
+        self._queue(project, lambda p: self._advanceProject(p, updateStage, status))
+
+    def flush(self):
+        """Write all queued project updates back to Insightly.
 
-        put(self.INSIGHTLY_PROJECTS_URI,
-            data=json.dumps(insightly_project),
-            headers={'Content-Type': 'application/json'},
-            auth=(self.INSIGHTLY_API_KEY, ''))
+        Each project with pending updates is fetched and written back once, with its updates applied in the order
+        they were queued. Cached projects are always revalidated against Insightly before being written back, so that
+        changes made on Insightly during the run are not overwritten.
+        """
+        while self._pending:
+            project_id, mutations = self._pending.popitem(last=False)
+            insightly_project = self._getInsightlyProject({'o': project_id}, revalidate=True)
+            map(lambda mutation: mutation(insightly_project), mutations)
+            self._putInsightlyProject(insightly_project)
@@ -1,12 +1,117 @@
 """Push updates to LDAP."""
 import ldap as _ldap
 import ldap.modlist as _modlist
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 import logging
-from __init__ import sanitize, fileToRedmine
+from collections import OrderedDict
+from __init__ import sanitize, fileToRedmine, MATCH_CACHE
 from unidecode import unidecode
 from canned_mailer import CannedMailer
 from insightly_updater import InsightlyUpdater
-from fuzzywuzzy.process import extractOne
+
+
+class AccountDirectory(object):
+
+    """In-memory snapshot of the LDAP accounts subtree.
+
+    Indexes account entries by employeeNumber and cn so that account lookups do not need a round trip to LDAP.
+    """
+
+    def __init__(self, entries):
+        """Index a list of account entries.
+
+        Args:
+            entries (List): Account entries as (dn, attributes) tuples, as returned by an LDAP search.
+        """
+        self._entries = {}
+        self._employees = {}
+        map(lambda e: self.add(*e), entries or [])
+
+    def _cn(self, dn):
+        return dn.split(',')[0].split('=', 1)[1]
+
+    def add(self, dn, attributes):
+        """Add an account entry to the snapshot.
+
+        Args:
+            dn (str): The distinguished name of the account.
+            attributes (dict): The attributes of the account, as a dictionary of lists of values.
+        """
+        attributes = dict((k, [v] if isinstance(v, str) else list(v)) for k, v in attributes.items())
+        attributes.setdefault('cn', [self._cn(dn)])
+        self.delete(dn)
+        self._entries[self._cn(dn).lower()] = (dn, attributes)
+        if 'employeeNumber' in attributes:
+            self._employees[attributes['employeeNumber'][0]] = self._cn(dn).lower()
+
+    def modify(self, dn, modlist):
+        """Apply an LDAP modify operation to an account entry on the snapshot.
+
+        Args:
+            dn (str): The distinguished name of the account.
+            modlist (List): The modifications as (operation, attribute, values) tuples, as per python ldap module.
+        """
+        entry = self._entries.get(self._cn(dn).lower())
+        if entry:
+            attributes = dict(entry[1])
+            for op, attribute, values in modlist:
+                values = [values] if isinstance(values, str) else list(values or [])
+                if op == _ldap.MOD_ADD:
+                    attributes[attribute] = attributes.get(attribute, []) + values
+                elif op == _ldap.MOD_DELETE and values:
+                    attributes[attribute] = filter(lambda v: v not in values, attributes.get(attribute, []))
+                else:
+                    attributes[attribute] = values
+                if not attributes[attribute]:
+                    attributes.pop(attribute)
+            self.add(entry[0], attributes)
+
+    def delete(self, dn):
+        """Remove an account entry from the snapshot.
+
+        Args:
+            dn (str): The distinguished name of the account.
+        """
+        entry = self._entries.pop(self._cn(dn).lower(), None)
+        if entry and 'employeeNumber' in entry[1]:
+            self._employees.pop(entry[1]['employeeNumber'][0], None)
+
+    def byEmployeeNumber(self, employeeNumber):
+        """Look an account up by its employeeNumber.
+
+        Args:
+            employeeNumber (str): The Insightly contact ID of the account.
+
+        Returns:
+            tuple: The distinguished name and the attributes of the account.
+            None: If there is no such account.
+        """
+        return self._entries.get(self._employees.get(str(employeeNumber)))
+
+    def byDN(self, dn):
+        """Look an account up by its distinguished name.
+
+        Args:
+            dn (str): The distinguished name of the account.
+
+        Returns:
+            tuple: The distinguished name and the attributes of the account.
+            None: If there is no such account.
+        """
+        entry = self._entries.get(self._cn(dn).lower())
+        return entry if entry and entry[0].lower() == dn.lower() else None
+
+    def hasCN(self, cn):
+        """Check whether an account name is taken.
+
+        Args:
+            cn (str): The account name to check.
+
+        Returns:
+            bool: True if there is an account with the given cn.
+        """
+        return cn.lower() in self._entries
 
 
 class ForgeLDAP(object):
@@ -14,14 +119,27 @@ class ForgeLDAP(object):
     """LDAP connection wrapper.
 
     Represents an LDAP connection and exposes LDAP CRUD operation funtions.
+    Write operations can be pipelined: they are issued asynchronously and their results collected once the operation
+    window is full, before any search, and before switching between the accounts and projects subtrees or writing
+    under an entry still in flight.
+
+    Attributes:
+        RESOLVE_BATCH (int): Maximum number of accounts to resolve per LDAP search.
+        PAGE_SIZE (int): Default number of entries to request per page on paged searches.
     """
 
+    RESOLVE_BATCH = 100
+    PAGE_SIZE = 500
+
     _c = None
     _logger = None
     _redmine_key = None
+    _accounts = None
+    _dns = None
+    _employees = None
     username = None
 
-    def __init__(self, user, pwd, host, redmine_key=None):
+    def __init__(self, user, pwd, host, redmine_key=None, window=0):
         """Initialize the LDAP connection.
 
         Initialize an LDAP object and bind it to the specified host.
@@ -30,9 +148,16 @@ class ForgeLDAP(object):
             user (str): The cn attribute of the account to use for binding. Must have administrator rights.
             pwd (str): The password for the specified user.
             host (str): The FQDN or IP of the host running the LDAP server. Connection uses ldaps protocol.
+            redmine_key (str, optional): Redmine REST API key to report failed operations with.
+            window (int, optional): Maximum number of add, modify and delete operations to keep in flight.
+                Operations are synchronous if 0.
         """
         self._logger = logging.getLogger(self.__class__.__name__)
         self._redmine_key = redmine_key
+        self._dns = {}
+        self._employees = {}
+        self._window = window
+        self._in_flight = OrderedDict()
 
         dn = 'cn=%s,%s' % (user, LDAPUpdater._LDAP_TREE['accounts'])
         _ldap.set_option(_ldap.OPT_X_TLS_REQUIRE_CERT, _ldap.OPT_X_TLS_ALLOW)
@@ -45,8 +170,67 @@ class ForgeLDAP(object):
 
         Ensures that the LDAP conection does not remain open.
         """
+        self.ldap_wait()
         self._c.unbind_s()
 
+    def _isAccount(self, dn):
+        return dn.lower().endswith(',' + LDAPUpdater._LDAP_TREE['accounts'])
+
+    def accountDirectory(self):
+        """Return a snapshot of the accounts subtree.
+
+        The snapshot is loaded from LDAP on first use, one page at a time, and kept coherent with the add, modify and
+        delete operations performed through this connection afterwards.
+
+        Returns:
+            AccountDirectory: The accounts subtree snapshot.
+        """
+        if self._accounts is None:
+            self._accounts = AccountDirectory(self.ldap_paged_search(LDAPUpdater._LDAP_TREE['accounts'],
+                                                                     _ldap.SCOPE_ONELEVEL,
+                                                                     attrlist=LDAPUpdater._ACCOUNT_ATTRIBUTES + ['cn']))
+        return self._accounts
+
+    def _cacheDNs(self, resolved):
+        for employeeNumber, dn in resolved:
+            self._dns[employeeNumber] = dn
+            self._employees[dn.lower()] = employeeNumber
+
+    def _invalidateDN(self, dn, employeeNumber=None):
+        for e in filter(None, [self._employees.pop(dn.lower(), None), employeeNumber]):
+            stale = self._dns.pop(e, None)
+            if stale:
+                self._employees.pop(stale.lower(), None)
+
+    def resolveDNs(self, employeeNumbers):
+        """Resolve the distinguished names of accounts.
+
+        Resolved names are cached for the lifetime of the connection. Names not cached yet are taken from the
+        accounts snapshot if loaded, otherwise looked up in batches with a single OR-filter search per batch.
+
+        Args:
+            employeeNumbers (List): The employeeNumber attributes of the accounts to resolve.
+
+        Returns:
+            dict: The distinguished names keyed by employeeNumber, accounts that do not exist are left out.
+        """
+        employeeNumbers = set(map(str, employeeNumbers))
+        missing = employeeNumbers - set(self._dns.keys())
+
+        if missing and self._accounts is not None:
+            self._cacheDNs((e, self._accounts.byEmployeeNumber(e)[0])
+                           for e in missing if self._accounts.byEmployeeNumber(e))
+            missing -= set(self._dns.keys())
+
+        missing = sorted(missing)
+        for chunk in [missing[i:i + self.RESOLVE_BATCH] for i in range(0, len(missing), self.RESOLVE_BATCH)]:
+            filterstr = '(|%s)' % ''.join('(employeeNumber=%s)' % escape_filter_chars(e) for e in chunk)
+            self._cacheDNs((entry[1]['employeeNumber'][0], entry[0]) for entry in
+                           self.ldap_search(LDAPUpdater._LDAP_TREE['accounts'], _ldap.SCOPE_ONELEVEL,
+                                            filterstr=filterstr, attrlist=['employeeNumber']) or [])
+
+        return dict((e, self._dns[e]) for e in employeeNumbers if e in self._dns)
+
     def ldap_search(self, *args, **kwargs):
         """Search LDAP.
 
@@ -60,67 +244,150 @@ class ForgeLDAP(object):
             List: A list containing the results from the LDAP search.
             None: If there are no results.
         """
+        self.ldap_wait()
         try:
             ldap_res = self._c.search_s(*args, **kwargs)
         except _ldap.NO_SUCH_OBJECT:
             return None
         return ldap_res
 
+    def ldap_paged_search(self, base, scope, filterstr='(objectClass=*)', attrlist=None, page_size=None):
+        """Search LDAP one page at a time.
+
+        Performs an LDAP search using the simple paged results control (RFC 2696), so that neither the server
+        size limit nor the size of the whole result set constrain the search.
+
+        Args:
+            base (str): The DN to search from.
+            scope (int): The search scope, as per python ldap module.
+            filterstr (str, optional): The search filter.
+            attrlist (List, optional): The attributes to retrieve, all of them if None.
+            page_size (int, optional): Number of entries to request per page, defaults to PAGE_SIZE.
+
+        Yields:
+            tuple: Each entry found, as a (dn, attributes) tuple.
+        """
+        self.ldap_wait()
+        control = SimplePagedResultsControl(True, size=page_size or self.PAGE_SIZE, cookie='')
+        while True:
+            try:
+                msgid = self._c.search_ext(base, scope, filterstr, attrlist, serverctrls=[control])
+                rtype, rdata, rmsgid, serverctrls = self._c.result3(msgid)
+            except _ldap.NO_SUCH_OBJECT:
+                return
+            for entry in filter(lambda e: e[0], rdata):
+                yield entry
+            cookies = [c.cookie for c in serverctrls if c.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                return
+            control.cookie = cookies[0]
+
+    def _track(self, operation, args):
+        if self._isAccount(args[0]):
+            if operation in ['add', 'delete']:
+                self._invalidateDN(args[0],
+                                   ''.join(dict(args[1]).get('employeeNumber', [])) if operation == 'add' else None)
+            if self._accounts is not None:
+                {'add': lambda: self._accounts.add(args[0], dict(args[1])),
+                 'modify': lambda: self._accounts.modify(*args[:2]),
+                 'delete': lambda: self._accounts.delete(args[0])}[operation]()
+
+    def _snapshot(self, dn):
+        return self._accounts.byDN(dn) if self._accounts is not None and self._isAccount(dn) else None
+
+    def _untrack(self, operation, args, previous):
+        if self._isAccount(args[0]):
+            if operation == 'add':
+                self._invalidateDN(args[0])
+            if self._accounts is not None:
+                self._accounts.delete(args[0])
+                if previous:
+                    self._accounts.add(*previous)
+
+    def _handleError(self, operation, args, err):
+        if operation == 'add' and isinstance(err, _ldap.ALREADY_EXISTS):
+            self._logger.info('%s; %s' % (err, 'Ignoring.'))
+        else:
+            self._logger.error('Try LDAP%s: %s' % (operation, list(args)))
+            self._logger.error(err)
+            if self._redmine_key:
+                fileToRedmine(key=self._redmine_key, subject=err.__class__.__name__, message='%s\nTry LDAP%s: %s'
+                              % (err, operation, args))
+
+    def _collect(self, msgid):
+        operation, args, previous = self._in_flight.pop(msgid)
+        try:
+            self._c.result3(msgid)
+        except _ldap.LDAPError, err:
+            if not (operation == 'add' and isinstance(err, _ldap.ALREADY_EXISTS)):
+                self._untrack(operation, args, previous)
+            self._handleError(operation, args, err)
+
+    def _mustWait(self, dn):
+        if not self._in_flight:
+            return False
+        dn = dn.lower()
+        last_dn = self._in_flight.values()[-1][1][0]
+        return self._isAccount(dn) != self._isAccount(last_dn) or \
+            any(pending == dn or dn.endswith(',' + pending) or pending.endswith(',' + dn)
+                for pending in map(lambda p: p[1][0].lower(), self._in_flight.values()))
+
+    def _perform(self, operation, args):
+        if self._window:
+            if self._mustWait(args[0]):
+                self.ldap_wait()
+            while len(self._in_flight) >= self._window:
+                self._collect(self._in_flight.keys()[0])
+            previous = self._snapshot(args[0])
+            self._in_flight[getattr(self._c, operation + '_ext')(*args)] = (operation, args, previous)
+            self._track(operation, args)
+        else:
+            try:
+                getattr(self._c, operation + '_s')(*args)
+                self._track(operation, args)
+            except _ldap.LDAPError, err:
+                self._handleError(operation, args, err)
+
+    def ldap_wait(self):
+        """Wait for all asynchronous operations in flight to complete.
+
+        Errors are logged and reported per operation, as for synchronous operations.
+        """
+        while self._in_flight:
+            self._collect(self._in_flight.keys()[0])
+
     def ldap_add(self, *args):
         """Add entries to LDAP.
 
-        Performs an LDAP add operation.
+        Performs an LDAP add operation, asynchronously if the connection has an operation window.
 
         Args:
             *args: positional arguments for ldap synchronous add, as per python ldap module.
             *kwargs: keyword arguments for ldap synchronous add, as per python ldap module.
         """
-        try:
-            self._c.add_s(*args)
-        except _ldap.ALREADY_EXISTS, err:
-            self._logger.info('%s; %s' % (err, 'Ignoring.'))
-        except _ldap.LDAPError, err:
-            self._logger.error('Try LDAPadd: %s' % list(args))
-            self._logger.error(err)
-            if self._redmine_key:
-                fileToRedmine(key=self._redmine_key, subject=err.__class__.__name__, message='%s\nTry LDAPadd: %s'
-                              % (err, args))
+        self._perform('add', args)
 
     def ldap_update(self, *args):
         """Modify entries on LDAP.
 
-        Performs an LDAP modify operation.
+        Performs an LDAP modify operation, asynchronously if the connection has an operation window.
 
         Args:
             *args: positional arguments for ldap synchronous modify, as per python ldap module.
             *kwargs: keyword arguments for ldap synchronous modify, as per python ldap module.
         """
-        try:
-            self._c.modify_s(*args)
-        except _ldap.LDAPError, err:
-            self._logger.error('Try LDAPmodify: %s' % list(args))
-            self._logger.error(err)
-            if self._redmine_key:
-                fileToRedmine(key=self._redmine_key, subject=err.__class__.__name__, message='%s\nTry LDAPmodify: %s'
-                              % (err, args))
+        self._perform('modify', args)
 
     def ldap_delete(self, *args):
         """Delete entries from LDAP.
 
-        Performs an LDAP delete operation.
+        Performs an LDAP delete operation, asynchronously if the connection has an operation window.
 
         Args:
             *args: positional arguments for ldap synchronous delete, as per python ldap module.
             *kwargs: keyword arguments for ldap synchronous delete, as per python ldap module.
         """
-        try:
-            self._c.delete_s(*args)
-        except _ldap.LDAPError, err:
-            self._logger.error('Try LDAPdelete: %s' % list(args))
-            self._logger.error(err)
-            if self._redmine_key:
-                fileToRedmine(key=self._redmine_key, subject=err.__class__.__name__, message='%s\nTry LDAPdelete: %s'
-                              % (err, args))
+        self._perform('delete', args)
 
 
 class LDAPUpdater:
@@ -161,6 +428,13 @@ class LDAPUpdater:
                                     (uniqueMember=cn={user_cn},%(s)s))\
                                   (!(cn:dn:={project_cn})))'.replace(' ', '') % {'s': _LDAP_TREE['accounts']}
 
+    _ORPHANS_FILTER = '(&(!(memberOf=*))(!(employeeType=disabled))%s)' % ''.join(['(!(cn=*%s*))' % account for
+                                                                                  account in _PROTECTED_ACCOUNTS])
+    _ADOPTED_FILTER = '(&(memberOf=*)(employeeType=disabled))'
+
+    _ACCOUNT_ATTRIBUTES = ['displayName', 'objectClass', 'employeeType', 'mobile', 'employeeNumber', 'sn', 'mail',
+                           'givenName']
+
     _PLACEHOLDER_NAME = 'FirstName'
     _PLACEHOLDER_SN = 'LastName'
 
@@ -193,9 +467,7 @@ class LDAPUpdater:
                                 splitName[0].decode('utf-8').lower()[:10])) if splitName else None
 
     def _ldapCN(self, userID, ldap_conn):
-        return ldap_conn.ldap_search(self._LDAP_TREE['accounts'], _ldap.SCOPE_ONELEVEL,
-                                     filterstr='employeeNumber=%s' % userID,
-                                     attrsonly=1)[0][0]
+        return ldap_conn.resolveDNs([userID])[str(userID)]
 
     def _createCN(self, user, ldap_conn):
         firstName = None if user['givenName'] is self._PLACEHOLDER_NAME else self._parseName(user['givenName'])
@@ -204,46 +476,50 @@ class LDAPUpdater:
         cn = '.'.join(filter(lambda n: n, [firstName, lastName]))
 
         suffix = 0
-        while ldap_conn.ldap_search('cn=%s,%s' % (cn, self._LDAP_TREE['accounts']), _ldap.SCOPE_BASE, attrsonly=1):
+        while ldap_conn.accountDirectory().hasCN(cn):
             cn = '%s.%s' % (cn[:-2], suffix)
             suffix += 1
 
         return cn
 
-    def _disableAndNotify(self, dn, ldap_conn):
-        account = ldap_conn.ldap_search(dn, _ldap.SCOPE_BASE, attrlist=['employeeType', 'cn', 'mail'])[0][1]
-        if account and ('employeeType' not in account or not extractOne(account['employeeType'][0],
-                                                                        ['disabled'], score_cutoff=80)):
+    def _disableAndNotify(self, entry, ldap_conn):
+        dn, account = entry
+        if account and ('employeeType' not in account or not MATCH_CACHE.extractOne(account['employeeType'][0],
+                                                                                    ['disabled'], score_cutoff=80)):
             ldap_conn.ldap_update(dn, [(_ldap.MOD_REPLACE, 'employeeType', 'disabled')])
-            map(lambda e: self.mailer.sendCannedMail(e, self.mailer.CANNED_MESSAGES['disabled_account'],
-                                                     account['cn'][0]), account['mail'])
+            map(lambda e: self.mailer.sendCannedMail(e, 'disabled_account', account['cn'][0]), account.get('mail', []))
+
+    def pruneAccounts(self, ldap_conn):
+        """Disable accounts that no longer belong to any project and re-enable those that do again.
 
-    def _pruneAccounts(self, ldap_conn):
-        # Disable orphans
+        Candidate accounts are selected by server-side filters and streamed from LDAP page by page.
+        Meant to be run once per synchronization, after all CRUD actions are performed.
+
+        Args:
+            ldap_conn (ForgeLDAP): An initialized LDAP connection to perform actions against.
+        """
+        # Disable orphans, collecting candidates first so that no writes interleave with the paged search
         map(lambda entry: self._disableAndNotify(entry, ldap_conn),
-            map(lambda dn: dn[0],
-                filter(lambda a: 'memberOf' not in a[1].keys() and not any(cn in a[0] for cn in
-                                                                           self._PROTECTED_ACCOUNTS),
-                       ldap_conn.ldap_search(self._LDAP_TREE['accounts'],
+            list(ldap_conn.ldap_paged_search(self._LDAP_TREE['accounts'],
                                              _ldap.SCOPE_ONELEVEL,
-                                             attrlist=['memberOf']))))
+                                             filterstr=self._ORPHANS_FILTER,
+                                             attrlist=['employeeType', 'cn', 'mail'])))
 
-        # Re-enable non orphans
-        map(lambda entry: ldap_conn.ldap_update(entry, [(_ldap.MOD_REPLACE, 'employeeType', None)]),
-            map(lambda dn: dn[0],
-                filter(lambda a: 'memberOf' in a[1].keys(),
-                       ldap_conn.ldap_search(self._LDAP_TREE['accounts'],
-                                             _ldap.SCOPE_ONELEVEL,
-                                             attrlist=['memberOf'],
-                                             filterstr='(employeeType=disabled)'))))
+        # Re-enable non orphans, likewise collecting candidates first
+        map(lambda dn: ldap_conn.ldap_update(dn, [(_ldap.MOD_REPLACE, 'employeeType', None)]),
+            list(entry[0] for entry in ldap_conn.ldap_paged_search(self._LDAP_TREE['accounts'],
+                                                                   _ldap.SCOPE_ONELEVEL,
+                                                                   filterstr=self._ADOPTED_FILTER,
+                                                                   attrlist=['1.1'])))
 
     def _getLDAPCompatibleProject(self, project, objectClass, ldap_conn):
         project = project.copy()
         project['objectClass'] = objectClass
-        project['owner'] = [self._ldapCN(owner['employeeNumber'], ldap_conn) for owner in project.pop('owner', [])]
-        project['member'] = [self._ldapCN(member['employeeNumber'], ldap_conn) for member in project.pop('member', [])]
-        project['seeAlso'] = [self._ldapCN(seeAlso['employeeNumber'],
-                                           ldap_conn) for seeAlso in project.pop('seeAlso', [])]
+        dns = ldap_conn.resolveDNs([account['employeeNumber'] for attribute in ['owner', 'member', 'seeAlso']
+                                    for account in project.get(attribute, [])])
+        project['owner'] = [dns[str(owner['employeeNumber'])] for owner in project.pop('owner', [])]
+        project['member'] = [dns[str(member['employeeNumber'])] for member in project.pop('member', [])]
+        project['seeAlso'] = [dns[str(seeAlso['employeeNumber'])] for seeAlso in project.pop('seeAlso', [])]
         project['uniqueMember'] = project['member']
         project.pop('tenants')
         project.pop('member' if objectClass is 'groupOfUniqueNames' else 'uniqueMember')
@@ -253,7 +529,7 @@ class LDAPUpdater:
     def _getLDAPCompatibleAccount(self, account):
         account = account.copy()
         account['objectClass'] = 'inetOrgPerson'
-        if extractOne('True', account.pop('isHidden'), score_cutoff=75):
+        if MATCH_CACHE.extractOne('True', account.pop('isHidden'), score_cutoff=75):
             account['employeeType'] = 'hidden'
 
         return account
@@ -283,47 +559,33 @@ class LDAPUpdater:
         return record
 
     def _createOrUpdate(self, member_list, ldap_conn):
-        new_records = filter(lambda m: not ldap_conn.ldap_search(self._LDAP_TREE['accounts'],
-                                                                 _ldap.SCOPE_ONELEVEL,
-                                                                 filterstr='employeeNumber=%s' % m['employeeNumber'],
-                                                                 attrsonly=1),
-                             member_list)
+        accounts = ldap_conn.accountDirectory()
+        new_records = filter(lambda m: not accounts.byEmployeeNumber(m['employeeNumber']), member_list)
 
         map(lambda c: ldap_conn.ldap_add('cn=%s,%s' % (self._createCN(c, ldap_conn), self._LDAP_TREE['accounts']),
                                          _modlist.addModlist(self._getLDAPCompatibleAccount(c),
                                                              ignore_attr_types=['cn'])),
             new_records)
 
-        map(lambda u: ldap_conn.ldap_update('%s' % self._ldapCN(u['employeeNumber'], ldap_conn),
-                                            _modlist.modifyModlist(ldap_conn.ldap_search(self._LDAP_TREE['accounts'],
-                                                                                         _ldap.SCOPE_ONELEVEL,
-                                                                                         filterstr='employeeNumber=%s'
-                                                                                         % u['employeeNumber'])[0][1],
+        map(lambda u: ldap_conn.ldap_update(accounts.byEmployeeNumber(u['employeeNumber'])[0],
+                                            _modlist.modifyModlist(accounts.byEmployeeNumber(u['employeeNumber'])[1],
                                                                    self._getLDAPCompatibleAccount(u),
                                                                    ignore_attr_types=['userPassword', 'cn'])),
-            filter(lambda m: cmp(dict(self._getLDAPCompatibleAccount(m)),
-                                 ldap_conn.ldap_search(self._LDAP_TREE['accounts'],
-                                                       _ldap.SCOPE_ONELEVEL,
-                                                       filterstr='employeeNumber=%s' % m['employeeNumber'],
-                                                       attrlist=['displayName', 'objectClass', 'employeeType',
-                                                                 'mobile', 'employeeNumber', 'sn',
-                                                                 'mail', 'givenName'])[0][1]),
+            filter(lambda m: accounts.byEmployeeNumber(m['employeeNumber']) and
+                   cmp(dict(self._getLDAPCompatibleAccount(m)),
+                       dict(filter(lambda a: a[0] in self._ACCOUNT_ATTRIBUTES,
+                                   accounts.byEmployeeNumber(m['employeeNumber'])[1].items()))),
                    member_list))
 
         return new_records
 
     def _sendNewAccountEmails(self, new_accounts, project_type, ldap_conn):
-        map(lambda d: map(lambda t: self.mailer.sendCannedMail(t,
-                                                               self.mailer.CANNED_MESSAGES['new_devel_account'] if
+        map(lambda d: map(lambda t: self.mailer.sendCannedMail(t, 'new_devel_account' if
                                                                project_type in [self.SDA, self.OS_TENANT] else
-                                                               self.mailer.CANNED_MESSAGES['new_partner_account'],
-                                                               d['cn'][0]),
-                          d['mail']),
-            map(lambda a: ldap_conn.ldap_search('ou=accounts,dc=forgeservicelab,dc=fi',
-                                                _ldap.SCOPE_ONELEVEL,
-                                                filterstr='employeeNumber=%s' % a['employeeNumber'],
-                                                attrlist=['cn', 'mail'])[0][1],
-                new_accounts))
+                                                               'new_partner_account', d['cn'][0]),
+                          d.get('mail', [])),
+            map(lambda a: ldap_conn.accountDirectory().byEmployeeNumber(a['employeeNumber'])[1],
+                filter(lambda n: ldap_conn.accountDirectory().byEmployeeNumber(n['employeeNumber']), new_accounts)))
 
     # deprecated
     def _ensureButlerService(self, record):
@@ -350,9 +612,7 @@ class LDAPUpdater:
             ldap_tenant['uniqueMember'] += ['cn=butler.service,ou=accounts,dc=forgeservicelab,dc=fi']
         ldap_conn.ldap_add(dn, _modlist.addModlist(ldap_tenant))
 
-        map(lambda ml: map(lambda e: self.mailer.sendCannedMail(e,
-                                                                self.mailer.CANNED_MESSAGES['added_to_tenant'],
-                                                                ldap_tenant['cn']),
+        map(lambda ml: map(lambda e: self.mailer.sendCannedMail(e, 'added_to_tenant', ldap_tenant['cn']),
                            ml),
             [ldap_conn.ldap_search(s, _ldap.SCOPE_BASE,
                                    attrlist=['mail'])[0][1]['mail'] for s in ldap_tenant['uniqueMember']])
@@ -387,13 +647,12 @@ class LDAPUpdater:
 
         self.updater.updateProject(project, status=self.updater.STATUS_RUNNING)
 
-        map(lambda a: map(lambda m: self.mailer.sendCannedMail(m, self.mailer.CANNED_MESSAGES['notify_admin_contact'],
-                                                               a['displayName']),
+        map(lambda a: map(lambda m: self.mailer.sendCannedMail(m, 'notify_admin_contact', a['displayName']),
                           a['mail']),
             project['seeAlso'])
 
-        map(lambda a: map(lambda m: self.mailer.sendCannedMail(m, self.mailer.CANNED_MESSAGES['added_to_project'],
-                                                               project['cn']), a['mail']), project['member'])
+        map(lambda a: map(lambda m: self.mailer.sendCannedMail(m, 'added_to_project', project['cn']), a['mail']),
+            project['member'])
 
     def _updateAndNotify(self, dn, record, ldap_conn, is_tenant=False):
         ldap_record = ldap_conn.ldap_search(dn, _ldap.SCOPE_BASE)[0][1]
@@ -415,22 +674,19 @@ class LDAPUpdater:
             if any(member_attribute in dict_record.keys() for member_attribute in ['member', 'uniqueMember']):
                 map(lambda email_list: map(lambda e: self.mailer
                                                          .sendCannedMail(e,
-                                                                         self.mailer.CANNED_MESSAGES['added_to_tenant']
+                                                                         'added_to_tenant'
                                                                          if any(self.OS_TENANT in s for s in
                                                                                 dict_record['description']) else
-                                                                         self.mailer.CANNED_MESSAGES[
-                                                                             'added_to_project'],
+                                                                         'added_to_project',
                                                                          dict_record['cn'][0]), email_list),
                     map(lambda s: ldap_conn.ldap_search(s, _ldap.SCOPE_BASE, attrlist=['mail'])[0][1]['mail'],
                         new_users))
                 map(lambda email_list: map(lambda e: self.mailer
                                            .sendCannedMail(e,
-                                                           self.mailer.CANNED_MESSAGES[
-                                                               'deleted_from_tenant']
+                                                           'deleted_from_tenant'
                                                            if any(self.OS_TENANT in s for s in
                                                                   dict_record['description']) else
-                                                           self.mailer.CANNED_MESSAGES[
-                                                               'deleted_from_project'],
+                                                           'deleted_from_project',
                                                            dict_record['cn'][0]), email_list),
                     map(lambda s: ldap_conn.ldap_search(s, _ldap.SCOPE_BASE, attrlist=['mail'])[0][1]['mail'],
                         gone_users))
@@ -509,11 +765,15 @@ class LDAPUpdater:
         """Perform a CRUD action against LDAP.
 
         Triggers the generation of LDAP payload and executes the requested action against the LDAP connection.
+        Insightly updates resulting from the action are written back once the action is complete.
 
         Args:
             action (str): The action to perform, one of ACTION_CREATE, ACTION_DELETE or ACTION_UPDATE.
             data_list (List): A list of the elements to use as payload for the CRUD action against LDAP.
             ldap_conn (ForgeLDAP): An initialized LDAP connection to perform actions against.
         """
-        map(lambda k: map(lambda p: self._actions[action](self, p, k, ldap_conn), data_list[k]), data_list.keys())
-        self._pruneAccounts(ldap_conn)
+        try:
+            map(lambda k: map(lambda p: self._actions[action](self, p, k, ldap_conn), data_list[k]), data_list.keys())
+        finally:
+            ldap_conn.ldap_wait()
+            self.updater.flush()
@@ -3,8 +3,10 @@
 
 Usage:
     ldapsync.py [-l <ldap_host>] -b <ldap_bind_cn> -p <ldap_bind_pwd> -i <insightly_api_key> -U <os_user> -P <os_pass>\
- -T <os_tenant> [-v <log_level>] [-R <redmine_api_key>] [-O <os_base_url>]
-    ldapsync.py -r <identity_file> [-v <log_level>]
+ -T <os_tenant> [-v <log_level>] [-R <redmine_api_key>] [-O <os_base_url>] [-d] [-s <state_file>]\
+ [-F <full_sync_hours>] [-W <ldap_window>] [-M <spool_dir>] [-Q <quota_workers>]
+    ldapsync.py -r <identity_file> [-v <log_level>] [-d] [-s <state_file>] [-F <full_sync_hours>] [-W <ldap_window>]\
+ [-M <spool_dir>] [-Q <quota_workers>]
     ldapsync.py -h | --help
 
 Options:
@@ -20,45 +22,55 @@ Options:
     -R --redmine_api <redmine_api_key>  Redmine REST API key.
     -r --resources <identity_file>      A file with the identity resources in the format [long_option_name]=[value].
     -v --verbose <log_level>            Verbose level, one of DEBUG, INFO, WARNING, ERROR, CRITICAL [default: WARNING]
+    -d --delta                          Synchronize only what changed on Insightly since the last successful run.
+    -s --state <state_file>             File to persist synchronization timestamps on for delta runs.
+                                        [default: /var/lib/insightly_sync/state.json]
+    -F --full_sync <full_sync_hours>    Hours between full synchronizations when running in delta mode [default: 24].
+    -W --ldap_window <ldap_window>      Maximum number of LDAP write operations in flight, 0 for synchronous writes
+                                        [default: 0].
+    -M --mail_spool <spool_dir>         Directory to spool outgoing mail on until delivered.
+                                        [default: /var/spool/insightly_sync]
+    -Q --quota_workers <quota_workers>  Number of OpenStack tenants to enforce quota on concurrently [default: 1].
 """
+import os
+import json
 import logging
 import traceback
-from __init__ import sanitize, fileToRedmine
-from fuzzywuzzy.process import extractOne
+from datetime import datetime, timedelta
+from __init__ import sanitize, fileToRedmine, MATCH_CACHE, RETRY_POLICY
 from insightly_updater import InsightlyUpdater
 from ldap_updater import LDAPUpdater, ForgeLDAP
 from quota_checker import QuotaChecker
-from requests import get
 from docopt import docopt
-from time import sleep
 
 TECH_ROLE = ['tech', 'tek', 'technical']
 ADMIN_ROLE = ['admin', 'admin contact']
 
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Delta runs fetch changes from this long before the last run started, to cover clock skew against Insightly.
+SYNC_OVERLAP = timedelta(minutes=10)
 
-def filterStagesByOrder(stage_order_list, stage_list, pipeline_list):
+
+def filterStagesByOrder(stage_order_list, stage_graph, pipeline_list):
     """Return a list of Insightly pipeline stage IDs based on their order.
 
     Filter the pipeline_list parameter to keep only pipelines matching PIPELINE_NAME.
-    Filter the stage_list parameter to keep only stages belonging to the filtered pipeline_list.
-    Filter the subset of stages that belong to the filtered pipeline list to keep only those with an order in the
-    stage_order_list parameter.
+    Look up the stages with an order in the stage_order_list parameter on each of the filtered pipelines.
 
     Args:
         stage_order_list (List): List of orders to keep after filtering.
-        stage_list (List): Complete list of stages to filter by order.
+        stage_graph (StageGraph): The stage graph of the Insightly instance, as built by InsightlyUpdater.
         pipeline_list: Complete list of pipelines to filter by name.
 
     Returns:
         List: The relevant stage IDs that matched the ordering criteria.
     """
-    return map(lambda cs: cs['STAGE_ID'],
-               filter(lambda s: s['PIPELINE_ID'] in map(lambda p: p['PIPELINE_ID'],
-                                                        filter(lambda q: q['PIPELINE_NAME'] in [LU.PIPELINE_NAME],
-                                                               pipeline_list)) and
-                      s['STAGE_ORDER'] in stage_order_list, stage_list
-                      )
-               )
+    pipeline_ids = map(lambda p: p['PIPELINE_ID'],
+                       filter(lambda q: q['PIPELINE_NAME'] in [LU.PIPELINE_NAME], pipeline_list))
+
+    return map(lambda key: stage_graph.by_order[key]['STAGE_ID'],
+               filter(lambda key: key in stage_graph.by_order,
+                      [(pipeline_id, order) for pipeline_id in pipeline_ids for order in stage_order_list]))
 
 
 def mapContactsToLDAP(contact_list):
@@ -86,15 +98,42 @@ def mapContactsToLDAP(contact_list):
                           }, contact_list) if contact_list else []
 
 
-def mapProjectsToLDAP(project_list, project_type, tenant_list=False):
+def indexRecords(record_list, key, transform=None):
+    """Build a lookup table for a list of Insightly records.
+
+    Args:
+        record_list (iterable): A list or stream of records as JSON from Insightly.
+        key (str): The ID field to index the records by, i.e. 'CONTACT_ID' or 'PROJECT_ID'.
+        transform (function, optional): Function to store each record through, so that only its result is kept
+            in memory rather than the whole record.
+
+    Returns:
+        dict: The records keyed by their ID, as tuples of the record position on record_list and the record itself,
+            or the result of transform on it.
+    """
+    return dict((r[key], (i, transform(r) if transform else r))
+                for i, r in enumerate(record_list)) if record_list else {}
+
+
+def _resolveLinks(link_list, record_index, link_key, role_list=None):
+    matches = dict(record_index[l[link_key]] for l in link_list
+                   if l[link_key] in record_index and
+                   (role_list is None or MATCH_CACHE.extractOne(str(l['ROLE']), role_list, score_cutoff=80)))
+
+    return [matches[position] for position in sorted(matches)]
+
+
+def mapProjectsToLDAP(project_list, project_type, tenant_index=None):
     """Create a payload for ldap_updater module calls.
 
     Generate a list of dictionaries mapping Insightly properties to LDAP attributes.
+    Project links are resolved against the CONTACTS index of contacts already mapped to LDAP attributes,
+    and the tenant_index parameter.
 
     Args:
         project_list (List): A list of projects as JSON from Insightly to be converted into LDAP-like dictionaries.
         project_type (List): A description of the type of project, one of 'SDA', 'FPA' or 'FPA (CRA)'.
-        tenant_list (List, optional): A list of tenants as JSON from Insightly,
+        tenant_index (dict, optional): An index of tenants as JSON from Insightly, as generated by indexRecords,
             i.e. projects on the 'OpenStack Tenant' category.
 
     Returns:
@@ -103,54 +142,116 @@ def mapProjectsToLDAP(project_list, project_type, tenant_list=False):
     return map(lambda p: {'o': str(p['PROJECT_ID']),
                           'description': project_type,
                           'cn': sanitize(p['PROJECT_NAME']),
-                          'owner': mapContactsToLDAP(filter(lambda owner: owner['CONTACT_ID'] in
-                                                            map(lambda c: c['CONTACT_ID'],
-                                                                filter(lambda o:
-                                                                       o['CONTACT_ID'] is not None and
-                                                                       extractOne(str(o['ROLE']),
-                                                                                  TECH_ROLE,
-                                                                                  score_cutoff=80),
-                                                                       p['LINKS'])), USERS)
-                                                     )[:1],
-                          'seeAlso': mapContactsToLDAP(filter(lambda admin: admin['CONTACT_ID'] in
-                                                              map(lambda c: c['CONTACT_ID'],
-                                                                  filter(lambda a:
-                                                                         a['CONTACT_ID'] is not None and
-                                                                         extractOne(str(a['ROLE']),
-                                                                                    ADMIN_ROLE,
-                                                                                    score_cutoff=80),
-                                                                         p['LINKS'])), USERS)
-                                                       ),
-                          'member': mapContactsToLDAP(filter(lambda member: member['CONTACT_ID'] in
-                                                             map(lambda c: c['CONTACT_ID'],
-                                                                 filter(lambda m:
-                                                                        m[
-                                                                            'CONTACT_ID'] is not None,
-                                                                        p['LINKS'])), USERS)
-                                                      ),
-                          'tenants': mapProjectsToLDAP(filter(lambda t:
-                                                              t['PROJECT_ID'] in
-                                                              map(lambda sp:
-                                                                  sp['SECOND_PROJECT_ID'],
-                                                                  filter(lambda l:
-                                                                         l[
-                                                                             'SECOND_PROJECT_ID'] is not None,
-                                                                         p['LINKS'])),
-                                                              tenant_list),
-                                                       project_type + [LU.OS_TENANT]) if tenant_list else [],
+                          'owner': _resolveLinks(p['LINKS'], CONTACTS, 'CONTACT_ID', role_list=TECH_ROLE)[:1],
+                          'seeAlso': _resolveLinks(p['LINKS'], CONTACTS, 'CONTACT_ID', role_list=ADMIN_ROLE),
+                          'member': _resolveLinks(p['LINKS'], CONTACTS, 'CONTACT_ID'),
+                          'tenants': mapProjectsToLDAP(_resolveLinks(p['LINKS'], tenant_index, 'SECOND_PROJECT_ID'),
+                                                       project_type + [LU.OS_TENANT]) if tenant_index else [],
                           }, project_list) if project_list else []
 
 
-def _retry_get_request(uri, **kwargs):
-    response = get(uri, **kwargs)
-    while response.status_code is not 200:
-        sleep(0.1)
-        response = get(uri, **kwargs)
+def loadSyncState(state_file):
+    """Read the timestamps of the last successful synchronizations.
+
+    Args:
+        state_file (str): Path to the state file.
+
+    Returns:
+        dict: The 'last_sync' and 'last_full_sync' UTC timestamps, empty if there is no previous state.
+    """
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def saveSyncState(state_file, state):
+    """Persist the timestamps of the last successful synchronizations.
+
+    Args:
+        state_file (str): Path to the state file.
+        state (dict): The 'last_sync' and 'last_full_sync' UTC timestamps.
+    """
+    state_dir = os.path.dirname(state_file)
+    if state_dir and not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(state_file + '.tmp', state_file)
+
+
+def isFullSyncDue(state, now, full_sync_hours):
+    """Decide whether a delta run must fall back to a full synchronization.
+
+    Args:
+        state (dict): The synchronization state as returned by loadSyncState.
+        now (datetime): The UTC start time of the current run.
+        full_sync_hours (int): Hours between full synchronizations.
+
+    Returns:
+        bool: True if there is no previous or valid state, or the last full synchronization is too old.
+    """
+    if not all(key in state for key in ['last_sync', 'last_full_sync']):
+        return True
+    try:
+        last_full_sync = datetime.strptime(state['last_full_sync'], TIMESTAMP_FORMAT)
+        datetime.strptime(state['last_sync'], TIMESTAMP_FORMAT)
+    except (TypeError, ValueError):
+        return True
+    return now - last_full_sync >= timedelta(hours=full_sync_hours)
+
+
+def _linkedIDs(record_list, link_key):
+    return set(l[link_key] for r in record_list for l in r['LINKS'] if l[link_key])
+
+
+def _fetchMissing(insightly_updater, uri, key, record_dict, ids):
+    missing = ids - set(record_dict.keys())
+    if missing:
+        record_dict.update((r[key], r) for r in insightly_updater.iterRecords(uri, ids=missing))
+
+
+def fetchDelta(insightly_updater, since, tenant_category):
+    """Fetch the Insightly projects and contacts affected by changes after a given time.
+
+    Projects updated after the given time, projects linked to updated contacts and parents of updated tenants are
+    affected. Tenants and contacts linked to affected projects are fetched along so their links can be resolved.
+
+    Args:
+        insightly_updater (InsightlyUpdater): The Insightly updater to fetch records with.
+        since (str): UTC timestamp of the last successful synchronization.
+        tenant_category (int): The ID of the Insightly category that represents an OpenStack tenant project.
+
+    Returns:
+        tuple: The affected projects including their tenants, and the contacts linked to them,
+            as lists of JSON from Insightly sorted by ID.
+    """
+    IU = insightly_updater
+    projects = dict((p['PROJECT_ID'], p) for p in IU.iterRecords(IU.INSIGHTLY_PROJECTS_URI, updated_since=since))
+    contacts = dict((c['CONTACT_ID'], c) for c in IU.iterRecords(IU.INSIGHTLY_CONTACTS_URI, updated_since=since))
+
+    _fetchMissing(IU, IU.INSIGHTLY_PROJECTS_URI, 'PROJECT_ID', projects, _linkedIDs(contacts.values(), 'PROJECT_ID'))
+    _fetchMissing(IU, IU.INSIGHTLY_PROJECTS_URI, 'PROJECT_ID', projects,
+                  _linkedIDs(filter(lambda p: p['CATEGORY_ID'] == tenant_category, projects.values()),
+                             'SECOND_PROJECT_ID'))
+    _fetchMissing(IU, IU.INSIGHTLY_PROJECTS_URI, 'PROJECT_ID', projects,
+                  _linkedIDs(filter(lambda p: p['CATEGORY_ID'] != tenant_category, projects.values()),
+                             'SECOND_PROJECT_ID'))
+    _fetchMissing(IU, IU.INSIGHTLY_CONTACTS_URI, 'CONTACT_ID', contacts, _linkedIDs(projects.values(), 'CONTACT_ID'))
+
+    return ([projects[k] for k in sorted(projects)], [contacts[k] for k in sorted(contacts)])
+
+
+def _retry_get_request(session, uri, **kwargs):
+    response = RETRY_POLICY.request(session.get, uri, **kwargs)
+    response.raise_for_status()
     return response
 
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
+    LU = None
     logging.basicConfig(filename='/var/log/insightly_sync.log',
                         format='%(asctime)s - [%(name)s] %(levelname)s: %(message)s',
                         level=arguments['--verbose'].upper())
@@ -161,36 +262,62 @@ if __name__ == '__main__':
                 [('--' + a.strip()).split('=')]), identity_file.readlines())
             identity_file.close()
 
+        INSIGHTLY_SESSION = InsightlyUpdater.createSession(arguments['--api_key'])
         IU = InsightlyUpdater(api_key=arguments['--api_key'],
-                              stages=_retry_get_request(InsightlyUpdater.INSIGHTLY_PIPELINE_STAGES_URI,
-                                                        auth=(arguments['--api_key'], '')).json(),
+                              stages=_retry_get_request(INSIGHTLY_SESSION,
+                                                        InsightlyUpdater.INSIGHTLY_PIPELINE_STAGES_URI).json(),
                               tenant_category=map(lambda t: t['CATEGORY_ID'],
                                                   filter(lambda c: c['CATEGORY_NAME'] == 'OpenStack Tenant',
-                                                         _retry_get_request(InsightlyUpdater.INSIGHTLY_CATEGORIES_URI,
-                                                                            auth=(arguments['--api_key'],
-                                                                                  '')).json()))[0])
+                                                         _retry_get_request(INSIGHTLY_SESSION,
+                                                                            InsightlyUpdater.INSIGHTLY_CATEGORIES_URI)
+                                                         .json()))[0],
+                              session=INSIGHTLY_SESSION)
         LU = LDAPUpdater(IU, arguments)
         QC = QuotaChecker(username=arguments['--os_user'], password=arguments['--os_pass'],
-                          tenantid=arguments['--os_tenant'], baseurl=arguments['--os_base_url'])
+                          tenantid=arguments['--os_tenant'], baseurl=arguments['--os_base_url'],
+                          workers=int(arguments['--quota_workers']))
 
         PIPELINES = filter(lambda p: p['PIPELINE_NAME'] in [LU.PIPELINE_NAME],
-                           _retry_get_request(IU.INSIGHTLY_PIPELINES_URI,
-                                              auth=(IU.INSIGHTLY_API_KEY, '')).json()
+                           _retry_get_request(IU.session, IU.INSIGHTLY_PIPELINES_URI).json()
                            )
 
         PROJ_CATEGORIES = dict(map(lambda pc: (pc['CATEGORY_NAME'], pc['CATEGORY_ID']),
                                    filter(lambda c: c['CATEGORY_NAME'] in [LU.SDA, LU.FPA, LU.FPA_CRA, LU.OS_TENANT],
-                                          _retry_get_request(IU.INSIGHTLY_CATEGORIES_URI,
-                                                             auth=(IU.INSIGHTLY_API_KEY, '')).json())))
-
-        PROJECTS = _retry_get_request(IU.INSIGHTLY_PROJECTS_URI, auth=(IU.INSIGHTLY_API_KEY, '')).json()
-        USERS = _retry_get_request(IU.INSIGHTLY_CONTACTS_URI, auth=(IU.INSIGHTLY_API_KEY, '')).json()
-
-        TENANTS = filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.OS_TENANT], PROJECTS)
-
-        creation_stages = filterStagesByOrder([4], IU.STAGES, PIPELINES)
-        update_stages = filterStagesByOrder([5, 6], IU.STAGES, PIPELINES)
-        deletion_stages = filterStagesByOrder([7], IU.STAGES, PIPELINES)
+                                          _retry_get_request(IU.session, IU.INSIGHTLY_CATEGORIES_URI).json())))
+
+        creation_stages = filterStagesByOrder([4], IU.STAGE_GRAPH, PIPELINES)
+        update_stages = filterStagesByOrder([5, 6], IU.STAGE_GRAPH, PIPELINES)
+        deletion_stages = filterStagesByOrder([7], IU.STAGE_GRAPH, PIPELINES)
+        relevant_stages = set(creation_stages + update_stages + deletion_stages)
+
+        SYNC_STATE = loadSyncState(arguments['--state']) if arguments['--delta'] else {}
+        sync_start = datetime.utcnow()
+        full_sync = not arguments['--delta'] or isFullSyncDue(SYNC_STATE, sync_start, int(arguments['--full_sync']))
+
+        if full_sync:
+            project_stream = IU.iterRecords(IU.INSIGHTLY_PROJECTS_URI)
+            contact_stream = IU.iterRecords(IU.INSIGHTLY_CONTACTS_URI)
+        else:
+            project_stream, contact_stream = fetchDelta(IU, SYNC_STATE['last_sync'], PROJ_CATEGORIES[LU.OS_TENANT])
+
+        # Stream projects, keeping only tenants, projects on relevant pipeline stages and tenant links for quotas.
+        PROJECTS = []
+        TENANT_LIST = []
+        QUOTA_LINKS = {LU.SDA: [], LU.FPA_CRA: []}
+        for project in project_stream:
+            if project['CATEGORY_ID'] == PROJ_CATEGORIES[LU.OS_TENANT]:
+                TENANT_LIST.append(project)
+            for project_type in filter(lambda t: project['CATEGORY_ID'] == PROJ_CATEGORIES[t], QUOTA_LINKS.keys()):
+                QUOTA_LINKS[project_type] += filter(lambda l: l['SECOND_PROJECT_ID'], project['LINKS'])
+            if project['CATEGORY_ID'] in PROJ_CATEGORIES.values() and \
+                    project['STAGE_ID'] in relevant_stages:
+                PROJECTS.append(project)
+
+        map(IU.cacheProject, PROJECTS + TENANT_LIST)
+
+        # Keep only the LDAP attributes of each contact while streaming them.
+        CONTACTS = indexRecords(contact_stream, 'CONTACT_ID', transform=lambda c: mapContactsToLDAP([c])[0])
+        TENANTS = indexRecords(TENANT_LIST, 'PROJECT_ID')
 
         # Filter projects by relevant pipeline stages.
         projects_to_be_created = filter(lambda p: p['CATEGORY_ID'] in PROJ_CATEGORIES.values() and
@@ -199,7 +326,8 @@ if __name__ == '__main__':
                                         p['STAGE_ID'] in update_stages, PROJECTS)
         projects_to_be_deleted = filter(lambda p: p['CATEGORY_ID'] in PROJ_CATEGORIES.values() and
                                         p['STAGE_ID'] in deletion_stages and
-                                        not extractOne(p['STATUS'], [IU.STATUS_COMPLETED], score_cutoff=80),
+                                        not MATCH_CACHE.extractOne(p['STATUS'], [IU.STATUS_COMPLETED],
+                                                                   score_cutoff=80),
                                         PROJECTS)
 
         creation = {
@@ -207,12 +335,12 @@ if __name__ == '__main__':
                                              p['CATEGORY_ID'] == PROJ_CATEGORIES[
                                                  LU.SDA],
                                              projects_to_be_created),
-                                      [LU.SDA], tenant_list=TENANTS),
+                                      [LU.SDA], tenant_index=TENANTS),
             LU.FPA_CRA: mapProjectsToLDAP(filter(lambda p:
                                                  p['CATEGORY_ID'] == PROJ_CATEGORIES[
                                                      LU.FPA_CRA],
                                                  projects_to_be_created),
-                                          [LU.FPA_CRA], tenant_list=TENANTS),
+                                          [LU.FPA_CRA], tenant_index=TENANTS),
             LU.FPA: mapProjectsToLDAP(filter(lambda p:
                                              p['CATEGORY_ID'] == PROJ_CATEGORIES[
                                                  LU.FPA],
@@ -223,10 +351,10 @@ if __name__ == '__main__':
         update = {
             LU.SDA: mapProjectsToLDAP(filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.SDA],
                                              projects_to_be_updated),
-                                      [LU.SDA], tenant_list=TENANTS),
+                                      [LU.SDA], tenant_index=TENANTS),
             LU.FPA_CRA: mapProjectsToLDAP(filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.FPA_CRA],
                                                  projects_to_be_updated),
-                                          [LU.FPA_CRA], tenant_list=TENANTS),
+                                          [LU.FPA_CRA], tenant_index=TENANTS),
             LU.FPA: mapProjectsToLDAP(filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.FPA],
                                              projects_to_be_updated),
                                       [LU.FPA])
@@ -235,45 +363,54 @@ if __name__ == '__main__':
         deletion = {
             LU.SDA: mapProjectsToLDAP(filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.SDA],
                                              projects_to_be_deleted),
-                                      [LU.SDA], tenant_list=TENANTS),
+                                      [LU.SDA], tenant_index=TENANTS),
             LU.FPA_CRA: mapProjectsToLDAP(filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.FPA_CRA],
                                                  projects_to_be_deleted),
-                                          [LU.FPA_CRA], tenant_list=TENANTS),
+                                          [LU.FPA_CRA], tenant_index=TENANTS),
             LU.FPA: mapProjectsToLDAP(filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.FPA],
                                              projects_to_be_deleted),
                                       [LU.FPA])
         }
 
         ldap_connection = ForgeLDAP(arguments['--bind'], arguments['--password'],
-                                    arguments['--ldap'], arguments['--redmine_api'])
+                                    arguments['--ldap'], arguments['--redmine_api'],
+                                    window=int(arguments['--ldap_window']))
 
         LU.Action(LU.ACTION_CREATE, creation, ldap_connection)
         LU.Action(LU.ACTION_UPDATE, update, ldap_connection)
         LU.Action(LU.ACTION_DELETE, deletion, ldap_connection)
-
-        QC.enforceQuotas(filter(lambda p: p['PROJECT_ID'] in
-                                filter(lambda tp: tp,
-                                       map(lambda t: t['SECOND_PROJECT_ID'],
-                                           [link for sublist in
-                                            map(lambda p: p['LINKS'],
-                                                filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.SDA],
-                                                       PROJECTS))
-                                            for link in sublist])),
-                                PROJECTS), LU.SDA, ldap_connection)
-
-        QC.enforceQuotas(filter(lambda p: p['PROJECT_ID'] in
-                                filter(lambda tp: tp,
-                                       map(lambda t: t['SECOND_PROJECT_ID'],
-                                           [link for sublist in
-                                            map(lambda p: p['LINKS'],
-                                                filter(lambda p: p['CATEGORY_ID'] == PROJ_CATEGORIES[LU.FPA_CRA],
-                                                       PROJECTS))
-                                            for link in sublist])),
-                                PROJECTS), LU.FPA_CRA, ldap_connection)
+        LU.pruneAccounts(ldap_connection)
+
+        QUOTA_FAILURES = QC.enforceQuotas(_resolveLinks(QUOTA_LINKS[LU.SDA], TENANTS, 'SECOND_PROJECT_ID'), LU.SDA,
+                                          ldap_connection)
+        QUOTA_FAILURES += QC.enforceQuotas(_resolveLinks(QUOTA_LINKS[LU.FPA_CRA], TENANTS, 'SECOND_PROJECT_ID'),
+                                           LU.FPA_CRA, ldap_connection)
+
+        if arguments['--delta']:
+            SYNC_STATE['last_sync'] = (sync_start - SYNC_OVERLAP).strftime(TIMESTAMP_FORMAT)
+            if full_sync:
+                SYNC_STATE['last_full_sync'] = sync_start.strftime(TIMESTAMP_FORMAT)
+            saveSyncState(arguments['--state'], SYNC_STATE)
+
+        if QUOTA_FAILURES and arguments['--redmine_api']:
+            fileToRedmine(key=arguments['--redmine_api'],
+                          subject='Could not enforce quota on %d tenants' % len(QUOTA_FAILURES),
+                          message='\n'.join(map(lambda (tenant, err): '%s: %s: %s' %
+                                                (tenant, err.__class__.__name__, err), QUOTA_FAILURES)),
+                          priority='high')
+
+        LU.mailer.flush()
+
+        logging.getLogger(__name__).debug('Fuzzy match cache: %d hits, %d misses' %
+                                          (MATCH_CACHE.hits, MATCH_CACHE.misses))
+        logging.getLogger(__name__).debug('Insightly latencies:\n%s' % IU.LATENCY.summary())
     except Exception, err:
         logger = logging.getLogger(__name__)
         logger.exception(err)
 
+        if LU:
+            LU.mailer.flush()
+
         if arguments['--redmine_api']:
             fileToRedmine(key=arguments['--redmine_api'], subject=err.__class__.__name__,
                           message=traceback.format_exc(), priority='critical')
@@ -1,9 +1,14 @@
 """Check OpenStack tenants' quotas."""
-from __init__ import sanitize
+import logging
+from __init__ import sanitize, RETRY_POLICY
 from time import sleep
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 from ldap import SCOPE_SUBORDINATE
-from swiftclient import service as swiftService
+from swiftclient import client as swiftClient
 from cinderclient.v2 import client as cinderClient
+from keystoneclient import session as keystoneSession
+from keystoneclient.auth.identity import v3 as keystoneAuth
 from keystoneclient.exceptions import NotFound
 from keystoneclient.v3 import client as keystoneClient
 from keystoneclient.v3.roles import RoleManager
@@ -20,11 +25,79 @@ from novaclient.exceptions import Unauthorized
 from ldap_updater import LDAPUpdater
 
 
+class CIDRAllocator:
+
+    """Allocate tenant subnets out of 192.168.0.0/16.
+
+    Tracks the /27 blocks on a bitmap and hands out the lowest free one. Allocation is safe for concurrent callers.
+
+    Attributes:
+        RESERVED (list): CIDRs that are never handed out.
+    """
+
+    RESERVED = ['192.168.192.0/27']
+
+    _BLOCKS = 256 * 8
+
+    def __init__(self, allocated=[]):
+        """Mark the given CIDRs as allocated.
+
+        Args:
+            allocated (List): CIDRs already in use, those outside of 192.168.0.0/16 or not /27, including IPv6
+                ones, are ignored.
+        """
+        self._lock = Lock()
+        self._used = bytearray(self._BLOCKS)
+        self._lowest = 0
+        map(lambda index: self._used.__setitem__(index, 1),
+            filter(lambda index: index is not None, map(self._index, self.RESERVED + allocated)))
+
+    def _index(self, cidr):
+        address, _, prefix = cidr.partition('/')
+        octets = address.split('.')
+        if prefix != '27' or len(octets) != 4 or not all(o.isdigit() for o in octets):
+            return None
+        octets = map(int, octets)
+        if octets[:2] != [192, 168] or octets[2] > 255 or octets[3] % 32:
+            return None
+        return octets[2] * 8 + octets[3] / 32
+
+    def allocate(self):
+        """Reserve the lowest free /27 block.
+
+        Returns:
+            str: The reserved block in CIDR notation.
+
+        Raises:
+            RuntimeError: If there are no free blocks left.
+        """
+        with self._lock:
+            while self._lowest < self._BLOCKS and self._used[self._lowest]:
+                self._lowest += 1
+            if self._lowest == self._BLOCKS:
+                raise RuntimeError('No free /27 block left on 192.168.0.0/16')
+            self._used[self._lowest] = 1
+            return '192.168.%d.%d/27' % (self._lowest / 8, self._lowest % 8 * 32)
+
+    def release(self, cidr):
+        """Return a block to the free pool.
+
+        Args:
+            cidr (str): A block previously handed out by allocate.
+        """
+        index = self._index(cidr)
+        if index is not None and cidr not in self.RESERVED:
+            with self._lock:
+                self._used[index] = 0
+                self._lowest = min(self._lowest, index)
+
+
 class QuotaChecker:
 
     """Check and enforce OpenStack tenant quota.
 
     Verifies that a given tenant does have its correct allocated quota.
+    Current quotas and flavor access are read first, and only the values that drifted from the definition are written.
 
     Attributes:
         DEFAULT_QUOTA (dict): The default quota for a service developer.
@@ -65,7 +138,7 @@ class QuotaChecker:
         'flavors': ['m1.tiny', 'm1.small', 'hadoop.small', 'hadoop.medium', 'hadoop.large']
     }
 
-    def __init__(self, username=None, password=None, tenantid=None, baseurl=None):
+    def __init__(self, username=None, password=None, tenantid=None, baseurl=None, workers=1):
         """Set instance authentication constants.
 
         Args:
@@ -73,83 +146,127 @@ class QuotaChecker:
             password (str): OpenStack administrator password.
             tenantid (str): OpenStack tenant for the administrator account.
             baseurl  (str): OpenStack environment URI.
+            workers  (int): Number of tenants to enforce quota on concurrently.
         """
         self._AUTH_USERNAME = username
         self._AUTH_PASSWORD = password
         self._AUTH_TENANTID = tenantid
         self._BASE_URL = baseurl
-        keystone = keystoneClient.Client(username=self._AUTH_USERNAME,
-                                         password=self._AUTH_PASSWORD,
-                                         project_name=self._AUTH_TENANTID,
-                                         auth_url='%s:5001/v3' % self._BASE_URL)
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._workers = max(1, workers)
+        self._lock = Lock()
+        self._networkLock = Lock()
+        self._networkIndex = None
+        self._publicNetworks = []
+        self._cidrs = None
+        self._sessions = {}
+        keystone = keystoneClient.Client(session=self._session())
+        self._nova = novaClient.Client(session=self._session())
+        self._cinder = cinderClient.Client(session=self._session())
+        self._neutron = neutronClient.Client(session=self._session())
         self._roleManager = RoleManager(keystone)
         self._groupManager = GroupManager(keystone)
         self._domainManager = DomainManager(keystone)
         self._projectManager = ProjectManager(keystone)
         self._roleAssignmentManager = RoleAssignmentManager(keystone)
+        self._groupMap = None
+        self._projectMap = None
+        self._flavors = []
+        self._flavorAccess = {}
+
+    def _session(self, tenant=None):
+        with self._lock:
+            if tenant not in self._sessions:
+                scope = {'project_id': tenant} if tenant else {'project_name': self._AUTH_TENANTID,
+                                                               'project_domain_id': 'default'}
+                self._sessions[tenant] = keystoneSession.Session(
+                    auth=keystoneAuth.Password(auth_url='%s:5001/v3' % self._BASE_URL,
+                                               username=self._AUTH_USERNAME,
+                                               password=self._AUTH_PASSWORD,
+                                               user_domain_id='default',
+                                               **scope),
+                    session=self._sessions[None].session if tenant else None)
+            return self._sessions[tenant]
+
+    def _loadGroupMap(self):
+        self._groupMap = dict(map(lambda group: (group.name, group), RETRY_POLICY.call(self._groupManager.list)))
 
     def _getOpenstackGroup(self, group):
-        try:
-            os_group = self._groupManager.find(name=group)
-        except:
-            return None
-        return os_group
+        if self._groupMap is None:
+            self._loadGroupMap()
 
-    def _getTenantId(self, tenant):
-        projectMap = dict(map(lambda assignment: (assignment.group['id'], assignment.scope['project']['id']),
-                              filter(lambda a: 'group' in a._info.keys(), self._roleAssignmentManager.list())))
+        return self._groupMap.get(group)
 
-        return projectMap[tenant].strip() if tenant in projectMap.keys() else None
+    def _loadProjectMap(self):
+        self._projectMap = dict(map(lambda assignment: (assignment.group['id'], assignment.scope['project']['id']),
+                                    filter(lambda a: 'group' in a._info.keys(),
+                                           RETRY_POLICY.call(self._roleAssignmentManager.list))))
+
+    def _getTenantId(self, tenant):
+        if self._projectMap is None:
+            self._loadProjectMap()
+
+        return self._projectMap[tenant].strip() if tenant in self._projectMap else None
+
+    def _loadNetworkIndex(self):
+        # Nothing is kept unless all listings succeed, so that a failed load is retried rather than leaving every
+        # tenant looking like it has no network.
+        networks = RETRY_POLICY.call(self._neutron.list_networks)['networks']
+        subnets = RETRY_POLICY.call(self._neutron.list_subnets)['subnets']
+        routers = RETRY_POLICY.call(self._neutron.list_routers)['routers']
+        index = {}
+        map(lambda network: self._indexResource(index, 'networks', network), networks)
+        map(lambda subnet: self._indexResource(index, 'subnets', subnet), subnets)
+        map(lambda router: self._indexResource(index, 'routers', router), routers)
+        cidrs = CIDRAllocator(map(lambda subnet: subnet['cidr'], subnets))
+        self._publicNetworks = map(lambda n: n['id'],
+                                   filter(lambda n: n['router:external'] and n['name'] == 'public', networks))
+        self._cidrs = cidrs
+        self._networkIndex = index
+
+    def _indexResource(self, index, kind, resource):
+        index.setdefault(resource['tenant_id'], {'networks': [], 'subnets': [], 'routers': []})[kind].append(resource)
+
+    def _tenantNetworks(self, tenant):
+        with self._networkLock:
+            if self._networkIndex is None:
+                self._loadNetworkIndex()
+            return self._networkIndex.get(tenant, {'networks': [], 'subnets': [], 'routers': []})
+
+    def _addNetworkResource(self, kind, resource):
+        with self._networkLock:
+            self._indexResource(self._networkIndex, kind, resource)
 
     def _ensureTenantNetwork(self, tenant):
-        neutron = neutronClient.Client(username=self._AUTH_USERNAME,
-                                       password=self._AUTH_PASSWORD,
-                                       tenant_id=self._AUTH_TENANTID,
-                                       auth_url='%s:5001/v2.0' % self._BASE_URL)
+        neutron = self._neutron
 
-        if not filter(lambda network: network['tenant_id'] == tenant, neutron.list_networks()['networks']):
+        if not self._tenantNetworks(tenant)['networks']:
             network = neutron.create_network({'network': {'name': 'default', 'tenant_id': tenant}})['network']
-            while not neutron.list_networks(id=network['id'])['networks']:
+            self._addNetworkResource('networks', network)
+            while not RETRY_POLICY.call(neutron.list_networks, id=network['id'])['networks']:
                 sleep(1)
 
-            allocated_cidrs = map(lambda chunk: (int(chunk[0]), int(chunk[1])),
-                                  map(lambda cidr: cidr['cidr'].split('/')[0].split('.')[-2:],
-                                      filter(lambda subnet: subnet['cidr'].endswith('/27'),
-                                             neutron.list_subnets()['subnets'])))
-
-            if (192, 0) in allocated_cidrs:
-                allocated_cidrs.remove((192, 0))
-
-            if allocated_cidrs:
-                max_bigchunk = max(map(lambda chunk: chunk[0], allocated_cidrs))
-                max_smlchunk = max(map(lambda chunk: chunk[1], filter(lambda c: c[0] == max_bigchunk, allocated_cidrs)))
-
-                if max_bigchunk == 191 and max_smlchunk == 224:
-                    max_bigchunk = 192
-                    max_smlchunk = 0
-
-                if max_smlchunk == 224:
-                    cidr = '.'.join([str(chunk) for chunk in [192, 168, max_bigchunk + 1, 0]]) + '/27'
-                else:
-                    cidr = '.'.join([str(chunk) for chunk in [192, 168, max_bigchunk, max_smlchunk + 32]]) + '/27'
-            else:
-                cidr = '192.168.0.0/27'
-            subnet = neutron.create_subnet({'subnet': {'name': 'default-subnet',
-                                                       'cidr': cidr,
-                                                       'dns_nameservers': ['193.166.4.24', '193.166.4.25'],
-                                                       'tenant_id': tenant,
-                                                       'network_id': network['id'],
-                                                       'ip_version': '4'}})['subnet']
-            while not neutron.list_subnets(id=subnet['id'])['subnets']:
+            cidr = self._cidrs.allocate()
+            try:
+                subnet = neutron.create_subnet({'subnet': {'name': 'default-subnet',
+                                                           'cidr': cidr,
+                                                           'dns_nameservers': ['193.166.4.24', '193.166.4.25'],
+                                                           'tenant_id': tenant,
+                                                           'network_id': network['id'],
+                                                           'ip_version': '4'}})['subnet']
+            except Exception:
+                self._cidrs.release(cidr)
+                raise
+            self._addNetworkResource('subnets', subnet)
+            while not RETRY_POLICY.call(neutron.list_subnets, id=subnet['id'])['subnets']:
                 sleep(1)
 
             router = neutron.create_router({'router': {'tenant_id': tenant,
                                                        'name': 'default-router'}})['router']
-            while not neutron.list_routers(id=router['id'])['routers']:
+            self._addNetworkResource('routers', router)
+            while not RETRY_POLICY.call(neutron.list_routers, id=router['id'])['routers']:
                 sleep(1)
-            public_net_id = filter(lambda n: n['router:external'],
-                                   neutron.list_networks(name='public')['networks'])[0]['id']
-            neutron.add_gateway_router(router['id'], {'network_id': public_net_id})
+            RETRY_POLICY.call(neutron.add_gateway_router, router['id'], {'network_id': self._publicNetworks[0]})
             neutron.add_interface_router(router['id'], {'subnet_id': subnet['id']})
 
     def _getTenantQuota(self, tenant, tenantType):
@@ -167,110 +284,153 @@ class QuotaChecker:
 
         return quota
 
+    def _loadFlavorAccess(self):
+        self._flavors = filter(lambda f: not f.is_public, RETRY_POLICY.call(self._nova.flavors.findall, is_public=None))
+        self._flavorAccess = dict(map(lambda f: (f.id, set(map(lambda access: access.tenant_id,
+                                                               RETRY_POLICY.call(self._nova.flavor_access.list,
+                                                                                 flavor=f)))),
+                                      self._flavors))
+
     def _grantAccess(self, client, flavor, tenant):
         try:
-            client.flavor_access.add_tenant_access(flavor, tenant)
+            RETRY_POLICY.call(client.flavor_access.add_tenant_access, flavor, tenant)
         except Conflict:
             pass
+        self._flavorAccess.setdefault(flavor.id, set()).add(tenant)
 
     def _revokeAccess(self, client, flavor, tenant):
         try:
-            client.flavor_access.remove_tenant_access(flavor, tenant)
+            RETRY_POLICY.call(client.flavor_access.remove_tenant_access, flavor, tenant)
         except NotFound:
             pass
-
-    def _enforceQuota(self, ldap_tenant, quotaDefinition, ldap_conn=None):
+        self._flavorAccess.setdefault(flavor.id, set()).discard(tenant)
+
+    def _syncFlavors(self, tenant, flavors, exclusive=True):
+        granted = filter(lambda f: f.name.encode() in flavors and tenant not in self._flavorAccess.get(f.id, ()),
+                         self._flavors)
+        revoked = filter(lambda f: exclusive and f.name.encode() not in flavors and
+                         tenant in self._flavorAccess.get(f.id, ()), self._flavors)
+        map(lambda f: self._grantAccess(self._nova, f, tenant), granted)
+        map(lambda f: self._revokeAccess(self._nova, f, tenant), revoked)
+
+        return map(lambda f: 'flavor %s granted' % f.name, granted) + \
+            map(lambda f: 'flavor %s revoked' % f.name, revoked)
+
+    def _drift(self, service, current, wanted):
+        drift = dict(filter(lambda (key, value): current.get(key) != value, wanted.iteritems()))
+        return drift, map(lambda key: '%s %s %s -> %s' % (service, key, current.get(key), drift[key]), sorted(drift))
+
+    def _syncQuota(self, tenant, quotaDefinition):
+        changes = []
+
+        storage_url = '%s:8081/v1/AUTH_%s' % (self._BASE_URL, RETRY_POLICY.call(self._projectManager.get, tenant).name)
+        drift, report = self._drift('swift', RETRY_POLICY.call(swiftClient.head_account, storage_url,
+                                                               self._session().get_token()),
+                                    {'x-account-meta-quota-bytes': str(quotaDefinition['swift_bytes'])})
+        if drift:
+            RETRY_POLICY.call(swiftClient.post_account, storage_url, self._session().get_token(), drift)
+            changes += report
+
+        drift, report = self._drift('cinder', RETRY_POLICY.call(self._cinder.quotas.get, tenant)._info,
+                                    {'gigabytes': quotaDefinition['cinder_GB']})
+        if drift:
+            RETRY_POLICY.call(self._cinder.quotas.update, tenant, **drift)
+            changes += report
+
+        drift, report = self._drift('nova', RETRY_POLICY.call(self._nova.quotas.get, tenant)._info,
+                                    dict(map(lambda key: (key, quotaDefinition[key]),
+                                             ['instances', 'cores', 'ram', 'floating_ips'])))
+        if drift:
+            RETRY_POLICY.call(self._nova.quotas.update, tenant, **drift)
+            changes += report
+
+        drift, report = self._drift('neutron', RETRY_POLICY.call(self._neutron.show_quota, tenant)['quota'],
+                                    {'floatingip': quotaDefinition['floating_ips']})
+        if drift:
+            RETRY_POLICY.call(self._neutron.update_quota, tenant, {'quota': drift})
+            changes += report
+
+        return changes + self._syncFlavors(tenant, quotaDefinition['flavors'])
+
+    def _enforceQuota(self, ldap_tenant, quotaDefinition, platformTenant=False):
         openstackGroup = self._getOpenstackGroup(ldap_tenant)
         if openstackGroup:
             tenant = self._getTenantId(ldap_tenant)
             if not tenant:
                 # Create or map tenant in openstack
-                project = self._projectManager.list(name=ldap_tenant)
-                if not project:
-                    project = self._projectManager.create(ldap_tenant, self._domainManager.find(id='default'))
-                self._roleManager.grant(self._roleManager.find(name='member').id,
-                                        group=openstackGroup.id,
-                                        project=project.id)
+                projects = RETRY_POLICY.call(self._projectManager.list, name=ldap_tenant)
+                project = projects[0] if projects else \
+                    self._projectManager.create(ldap_tenant, RETRY_POLICY.call(self._domainManager.find, id='default'))
+                RETRY_POLICY.call(self._roleManager.grant, RETRY_POLICY.call(self._roleManager.find, name='member').id,
+                                  group=openstackGroup.id,
+                                  project=project.id)
+                self._projectMap[openstackGroup.id] = project.id
                 tenant = project.id
 
-            if ldap_conn and ldap_tenant in map(lambda t: t[0].split(',')[0].split('=')[1],
-                                                ldap_conn.ldap_search('cn=digile.platform,ou=projects,\
-                                                                       dc=forgeservicelab,dc=fi',
-                                                                      SCOPE_SUBORDINATE, attrsonly=1)):
-                with novaClient.Client(username=self._AUTH_USERNAME,
-                                       api_key=self._AUTH_PASSWORD,
-                                       tenant_id=tenant,
-                                       auth_url='%s:5001/v2.0' % self._BASE_URL) as nova:
-                    try:
-                        nova.security_group_rules.create(nova.security_groups.find(name='default').id,
-                                                         ip_protocol='tcp',
-                                                         from_port=22,
-                                                         to_port=22,
-                                                         cidr='86.50.27.230/32')
-                    except Unauthorized:
-                        # butler.service not yet part of the tenant, wait for next round.
-                        pass
-                    except BadRequest:
-                        # Rule already exists, that's OK.
-                        pass
+            if platformTenant:
+                nova = novaClient.Client(session=self._session(tenant))
+                try:
+                    nova.security_group_rules.create(RETRY_POLICY.call(nova.security_groups.find, name='default').id,
+                                                     ip_protocol='tcp',
+                                                     from_port=22,
+                                                     to_port=22,
+                                                     cidr='86.50.27.230/32')
+                except Unauthorized:
+                    # butler.service not yet part of the tenant, wait for next round.
+                    pass
+                except BadRequest:
+                    # Rule already exists, that's OK.
+                    pass
 
             self._ensureTenantNetwork(tenant)
 
-            if quotaDefinition:
-                service_opts = {
-                    'meta': ['quota-bytes:%s' % quotaDefinition['swift_bytes']],
-                    'os_username': self._AUTH_USERNAME,
-                    'os_password': self._AUTH_PASSWORD,
-                    'os_auth_url': '%s:5001/v2.0' % self._BASE_URL,
-                    'os_storage_url': '%s:8081/v1/AUTH_%s' % (self._BASE_URL, self._projectManager.get(tenant).name),
-                    'os_tenant_name': self._AUTH_TENANTID
-                }
-
-                swift = swiftService.SwiftService(options=service_opts)
-                swift.post()
-                del swift
-
-                cinder = cinderClient.Client(username=self._AUTH_USERNAME,
-                                             api_key=self._AUTH_PASSWORD,
-                                             tenant_id=self._AUTH_TENANTID,
-                                             auth_url=service_opts['os_auth_url'])
-                cinder.quotas.update(tenant, gigabytes=quotaDefinition['cinder_GB'])
-                del cinder
-
-                with novaClient.Client(username=self._AUTH_USERNAME,
-                                       api_key=self._AUTH_PASSWORD,
-                                       tenant_id=self._AUTH_TENANTID,
-                                       auth_url=service_opts['os_auth_url']) as nova:
-                    nova.quotas.update(tenant,
-                                       instances=quotaDefinition['instances'],
-                                       cores=quotaDefinition['cores'],
-                                       ram=quotaDefinition['ram'],
-                                       floating_ips=quotaDefinition['floating_ips'])
-                    allFlavors = nova.flavors.findall(is_public=None)
-                    map(lambda f: self._grantAccess(nova, f, tenant),
-                        filter(lambda f: f.name.encode() in quotaDefinition['flavors'], allFlavors))
-                    map(lambda f: self._revokeAccess(nova, f, tenant),
-                        filter(lambda f: f.name.encode() not in quotaDefinition['flavors'], allFlavors))
-
-                neutron = neutronClient.Client(username=self._AUTH_USERNAME,
-                                               password=self._AUTH_PASSWORD,
-                                               tenant_id=self._AUTH_TENANTID,
-                                               auth_url=service_opts['os_auth_url'])
-                neutron.update_quota(tenant, {'quota': {'floatingip': quotaDefinition['floating_ips']}})
-                del neutron
+            changes = self._syncQuota(tenant, quotaDefinition) if quotaDefinition else []
+            changes += self._syncFlavors(tenant, ['m1.tiny'], exclusive=False)
 
-            with novaClient.Client(username=self._AUTH_USERNAME,
-                                   api_key=self._AUTH_PASSWORD,
-                                   tenant_id=self._AUTH_TENANTID,
-                                   auth_url='%s:5001/v2.0' % self._BASE_URL) as nova:
-                self._grantAccess(nova, nova.flavors.find(name='m1.tiny', is_public=None), tenant)
+            if changes:
+                self._logger.info('Quota drift on tenant %s: %s' % (ldap_tenant, ', '.join(changes)))
+            else:
+                self._logger.debug('No quota drift on tenant %s' % ldap_tenant)
+
+    def _enforceIsolated(self, ldap_tenant, quotaDefinition, platformTenant):
+        try:
+            self._enforceQuota(ldap_tenant, quotaDefinition, platformTenant)
+        except Exception, err:
+            self._logger.exception('Could not enforce quota on tenant %s: %s' % (ldap_tenant, err))
+            return ldap_tenant, err
 
     def enforceQuotas(self, tenantList, tenantsType, ldap_conn=None):
         """Enforce the quota for each tenant on the list.
 
+        Tenants are processed concurrently by as many workers as configured. A failure on one tenant does not stop
+        the others, failures are logged and returned once all tenants have been processed.
+
         Args:
             tenantList (List): A list of tenants as JSON from Insightly.
             tenantsType (str): A description of the type of tenant, one of 'SDA', 'FPA' or 'FPA (CRA)'.
+
+        Returns:
+            List: The tenants quota could not be enforced on, as (tenant name, exception) tuples.
         """
-        map(lambda t: self._enforceQuota(sanitize(t['PROJECT_NAME']), self._getTenantQuota(t, tenantsType),
-                                         ldap_conn), tenantList)
+        self._loadGroupMap()
+        self._loadProjectMap()
+        self._loadFlavorAccess()
+        self._networkIndex = None
+        self._cidrs = None
+        platformTenants = set(map(lambda t: t[0].split(',')[0].split('=')[1],
+                                  ldap_conn.ldap_search('cn=digile.platform,ou=projects,dc=forgeservicelab,dc=fi',
+                                                        SCOPE_SUBORDINATE, attrsonly=1))) if ldap_conn else set()
+
+        tenants = map(lambda t: (sanitize(t['PROJECT_NAME']), self._getTenantQuota(t, tenantsType)), tenantList)
+        enforce = lambda (name, quota): self._enforceIsolated(name, quota, name in platformTenants)
+        if self._workers > 1 and len(tenants) > 1:
+            pool = ThreadPool(min(self._workers, len(tenants)))
+            try:
+                failures = filter(None, pool.map(enforce, tenants))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            failures = filter(None, map(enforce, tenants))
+
+        return failures